@@ -0,0 +1,364 @@
+"""
+Bitboard backend for the chess engine. The position is kept as a set of 64-bit integers, one for every piece
+and one for every color, next to the usual 8x8 board so Move objects and the GUI keep working unchanged.
+Squares are numbered row * 8 + col, so square 0 is a8 and square 63 is h1, exactly like board[row][col].
+"""
+
+import chess_engine
+
+WHITE = 'w'
+BLACK = 'b'
+PIECE_NAMES = ('wP', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bP', 'bN', 'bB', 'bR', 'bQ', 'bK')
+ALL_SQUARES = (1 << 64) - 1
+
+KNIGHT_OFFSETS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+KING_OFFSETS = ((1, 0), (1, 1), (1, -1), (-1, 0), (-1, 1), (-1, -1), (0, 1), (0, -1))
+# The first four directions are orthogonal (rook), the last four are diagonal (bishop).
+# Every direction is followed by its opposite, so the opposite of direction i is i ^ 1.
+DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, 1), (-1, 1), (1, -1))
+
+
+def _leaper_attacks(offsets):
+    """
+    Precompute the attack set of a non-sliding piece for all 64 squares.
+    """
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        attacks = 0
+        for d_row, d_col in offsets:
+            end_row = row + d_row
+            end_col = col + d_col
+            if 0 <= end_row < 8 and 0 <= end_col < 8:
+                attacks |= 1 << (end_row * 8 + end_col)
+        table.append(attacks)
+    return table
+
+
+def _ray_table(direction):
+    """
+    Precompute for all 64 squares the squares reachable in one direction on an empty board.
+    """
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        ray = 0
+        end_row = row + direction[0]
+        end_col = col + direction[1]
+        while 0 <= end_row < 8 and 0 <= end_col < 8:
+            ray |= 1 << (end_row * 8 + end_col)
+            end_row += direction[0]
+            end_col += direction[1]
+        table.append(ray)
+    return table
+
+
+KNIGHT_ATTACKS = _leaper_attacks(KNIGHT_OFFSETS)
+KING_ATTACKS = _leaper_attacks(KING_OFFSETS)
+# White pawns attack towards row 0, black pawns towards row 7.
+PAWN_ATTACKS = {
+    WHITE: _leaper_attacks(((-1, -1), (-1, 1))),
+    BLACK: _leaper_attacks(((1, -1), (1, 1))),
+}
+RAYS = [_ray_table(d) for d in DIRECTIONS]
+# Rays going to higher square numbers are blocked by their lowest set bit, the others by their highest one.
+RAY_IS_POSITIVE = [d[0] * 8 + d[1] > 0 for d in DIRECTIONS]
+
+
+def _line_tables():
+    """
+    BETWEEN[a][b] holds the squares strictly between a and b, LINE[a][b] the whole board line through
+    both of them. Both are empty when the squares are not on a common rank, file or diagonal.
+    """
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        for i, (d_row, d_col) in enumerate(DIRECTIONS):
+            full_line = RAYS[i][sq] | RAYS[i ^ 1][sq] | (1 << sq)
+            path = 0
+            row, col = divmod(sq, 8)
+            row += d_row
+            col += d_col
+            while 0 <= row < 8 and 0 <= col < 8:
+                target = row * 8 + col
+                between[sq][target] = path
+                line[sq][target] = full_line
+                path |= 1 << target
+                row += d_row
+                col += d_col
+    return between, line
+
+
+BETWEEN, LINE = _line_tables()
+
+
+def _slider_attacks(sq, occupied, first_direction, last_direction):
+    # Classical ray lookup: take the empty-board ray, find the first blocker and
+    # cut off everything behind it with the blocker's own ray in the same direction.
+    attacks = 0
+    for i in range(first_direction, last_direction):
+        ray = RAYS[i][sq]
+        blockers = ray & occupied
+        if blockers:
+            if RAY_IS_POSITIVE[i]:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= RAYS[i][blocker]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, 0, 4)
+
+
+def bishop_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, 4, 8)
+
+
+def squares_of(bb):
+    """
+    Yield the square numbers of all set bits, lowest first.
+    """
+    while bb:
+        bit = bb & -bb
+        yield bit.bit_length() - 1
+        bb ^= bit
+
+
+class BitboardGameState(chess_engine.GameState):
+    """
+    Drop-in replacement for GameState that generates moves from bitboards instead of scanning the board.
+    The 8x8 board, the move log and the Move objects are kept exactly as in GameState.
+    """
+
+    def load_bitboards(self):
+        """
+        Rebuild all bitboards from self.board. Needed only when the board is changed by hand,
+        set_position already calls it.
+        """
+        self.pieces = {name: 0 for name in PIECE_NAMES}
+        self.colors = {WHITE: 0, BLACK: 0}
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece != '--':
+                    bit = 1 << (row * 8 + col)
+                    self.pieces[piece] |= bit
+                    self.colors[piece[0]] |= bit
+
+    def set_position(self, board, white_to_move, castling_rights, en_passant_possible=(), halfmove_clock=0,
+                     fullmove_number=1):
+        super().set_position(board, white_to_move, castling_rights, en_passant_possible, halfmove_clock,
+                             fullmove_number)
+        self.load_bitboards()
+
+    def make_move(self, move):
+        squares = self.touched_squares(move)
+        before = [self.board[row][col] for row, col in squares]
+        super().make_move(move)
+        self.sync_squares(squares, before)
+
+    def undo_move(self):
+        if len(self.move_log) == 0:
+            return
+        squares = self.touched_squares(self.move_log[-1])
+        before = [self.board[row][col] for row, col in squares]
+        super().undo_move()
+        self.sync_squares(squares, before)
+
+    @staticmethod
+    def touched_squares(move):
+        """
+        All squares whose content can change when the move is made or taken back.
+        """
+        squares = [(move.start_row, move.start_col), (move.end_row, move.end_col)]
+        if move.is_en_passant_move:
+            squares.append((move.start_row, move.end_col))
+        if move.is_castle_move:
+            if move.end_col - move.start_col == 2:
+                squares.append((move.end_row, move.end_col+1))
+                squares.append((move.end_row, move.end_col-1))
+            else:
+                squares.append((move.end_row, move.end_col-2))
+                squares.append((move.end_row, move.end_col+1))
+        return squares
+
+    def sync_squares(self, squares, before):
+        """
+        Bring the bitboards in line with the board for the given squares, knowing what was there before.
+        """
+        for (row, col), old_piece in zip(squares, before):
+            new_piece = self.board[row][col]
+            if old_piece == new_piece:
+                continue
+            bit = 1 << (row * 8 + col)
+            if old_piece != '--':
+                self.pieces[old_piece] ^= bit
+                self.colors[old_piece[0]] ^= bit
+            if new_piece != '--':
+                self.pieces[new_piece] ^= bit
+                self.colors[new_piece[0]] ^= bit
+
+    def attackers_to(self, sq, color, occupied):
+        """
+        Bitboard of the pieces of the given color attacking sq, with sliders blocked by occupied.
+        """
+        pieces = self.pieces
+        # A pawn of our color on sq would attack exactly the squares enemy pawns attack sq from.
+        defender = BLACK if color == WHITE else WHITE
+        return (PAWN_ATTACKS[defender][sq] & pieces[color + 'P']) | \
+            (KNIGHT_ATTACKS[sq] & pieces[color + 'N']) | \
+            (KING_ATTACKS[sq] & pieces[color + 'K']) | \
+            (rook_attacks(sq, occupied) & (pieces[color + 'R'] | pieces[color + 'Q'])) | \
+            (bishop_attacks(sq, occupied) & (pieces[color + 'B'] | pieces[color + 'Q']))
+
+    def square_under_attack(self, row, col):
+        """
+        Determine if enemy can attack the square row col
+        """
+        enemy_color = BLACK if self.white_to_move else WHITE
+        occupied = self.colors[WHITE] | self.colors[BLACK]
+        return self.attackers_to(row * 8 + col, enemy_color, occupied) != 0
+
+    def get_pins(self, king_sq, ally_color, enemy_color, occupied):
+        """
+        Returns a dict from each pinned ally square to the line it is allowed to move along.
+        """
+        pieces = self.pieces
+        snipers = (rook_attacks(king_sq, 0) & (pieces[enemy_color + 'R'] | pieces[enemy_color + 'Q'])) | \
+            (bishop_attacks(king_sq, 0) & (pieces[enemy_color + 'B'] | pieces[enemy_color + 'Q']))
+        pins = {}
+        ally = self.colors[ally_color]
+        for sniper_sq in squares_of(snipers):
+            blockers = BETWEEN[king_sq][sniper_sq] & occupied
+            if blockers and blockers & (blockers - 1) == 0 and blockers & ally:
+                pins[blockers.bit_length() - 1] = LINE[king_sq][sniper_sq]
+        return pins
+
+    def generate_legal_moves(self, squares=chess_engine.ALL_SQUARES):
+        """
+        Bitboards produce the whole list at once, only the moves of the pieces on the given squares are generated.
+        """
+        if squares is chess_engine.ALL_SQUARES:
+            yield from self.legal_moves()
+            return
+        from_mask = 0
+        for row, col in squares:
+            from_mask |= 1 << (row * 8 + col)
+        yield from self.legal_moves(from_mask)
+
+    def legal_moves(self, from_mask=ALL_SQUARES):
+        """
+        All moves considering checks, without touching check_mate and stale_mate.
+        With from_mask only the moves of the pieces on those squares are generated.
+        """
+        moves = []
+        board = self.board
+        Move = chess_engine.Move
+        if self.white_to_move:
+            ally_color, enemy_color, forward, start_row = WHITE, BLACK, -8, 6
+        else:
+            ally_color, enemy_color, forward, start_row = BLACK, WHITE, 8, 1
+        pieces = self.pieces
+        ally = self.colors[ally_color]
+        enemy = self.colors[enemy_color]
+        occupied = ally | enemy
+        not_ally = ~ally & ALL_SQUARES
+        king = pieces[ally_color + 'K']
+        king_sq = king.bit_length() - 1
+        king_row, king_col = divmod(king_sq, 8)
+        checkers = self.attackers_to(king_sq, enemy_color, occupied)
+        self.in_check = checkers != 0
+
+        # King steps, checked with the king lifted off the board so it cannot hide behind itself.
+        without_king = occupied ^ king
+        for end_sq in squares_of(KING_ATTACKS[king_sq] & not_ally if king & from_mask else 0):
+            if not self.attackers_to(end_sq, enemy_color, without_king):
+                moves.append(Move((king_row, king_col), divmod(end_sq, 8), board))
+
+        # In double check only the king can move.
+        if checkers & (checkers - 1) == 0:
+            if checkers:
+                check_mask = BETWEEN[king_sq][checkers.bit_length() - 1] | checkers
+            else:
+                check_mask = ALL_SQUARES
+                if king & from_mask:
+                    self.get_bitboard_castle_moves(king_sq, ally_color, enemy_color, occupied, moves)
+            pins = self.get_pins(king_sq, ally_color, enemy_color, occupied)
+            targets = not_ally & check_mask
+
+            for sq in squares_of(pieces[ally_color + 'N'] & from_mask):
+                if sq in pins:  # a pinned knight can never move
+                    continue
+                for end_sq in squares_of(KNIGHT_ATTACKS[sq] & targets):
+                    moves.append(Move(divmod(sq, 8), divmod(end_sq, 8), board))
+
+            for attacks, kinds in ((bishop_attacks, 'BQ'), (rook_attacks, 'RQ')):
+                sliders = (pieces[ally_color + kinds[0]] | pieces[ally_color + kinds[1]]) & from_mask
+                for sq in squares_of(sliders):
+                    end_squares = attacks(sq, occupied) & targets
+                    if sq in pins:
+                        end_squares &= pins[sq]
+                    for end_sq in squares_of(end_squares):
+                        moves.append(Move(divmod(sq, 8), divmod(end_sq, 8), board))
+
+            self.get_bitboard_pawn_moves(
+                ally_color, enemy_color, forward, start_row, king_sq, occupied, check_mask, pins, moves, from_mask)
+
+        return moves
+
+    def get_bitboard_pawn_moves(self, ally_color, enemy_color, forward, start_row,
+                                king_sq, occupied, check_mask, pins, moves, from_mask=ALL_SQUARES):
+        board = self.board
+        Move = chess_engine.Move
+        pieces = self.pieces
+        enemy = self.colors[enemy_color]
+        ep_bit = 0
+        if self.en_passant_possible:
+            ep_bit = 1 << (self.en_passant_possible[0] * 8 + self.en_passant_possible[1])
+        for sq in squares_of(pieces[ally_color + 'P'] & from_mask):
+            allowed = check_mask & pins.get(sq, ALL_SQUARES)
+            start_sq = divmod(sq, 8)
+            one_step = sq + forward
+            if not occupied >> one_step & 1:
+                if allowed >> one_step & 1:
+                    self.add_pawn_move(start_sq, divmod(one_step, 8), moves)
+                two_steps = one_step + forward
+                if start_sq[0] == start_row and not occupied >> two_steps & 1 and allowed >> two_steps & 1:
+                    moves.append(Move(start_sq, divmod(two_steps, 8), board))
+            attacks = PAWN_ATTACKS[ally_color][sq]
+            for end_sq in squares_of(attacks & enemy & allowed):
+                self.add_pawn_move(start_sq, divmod(end_sq, 8), moves)
+            if attacks & ep_bit:
+                # En passant removes two pawns from one rank at once, so rather than reasoning about
+                # pins we just look whether the king is attacked once the capture is made.
+                captured_bit = ep_bit << 8 if ally_color == WHITE else ep_bit >> 8
+                after = (occupied ^ (1 << sq) ^ captured_bit) | ep_bit
+                attackers = self.attackers_to(king_sq, enemy_color, after) & ~captured_bit
+                if not attackers:
+                    moves.append(Move(start_sq, self.en_passant_possible, board, is_en_passant=True))
+
+    def get_bitboard_castle_moves(self, king_sq, ally_color, enemy_color, occupied, moves):
+        rights = self.castling_rights
+        if ally_color == WHITE:
+            king_side = rights & chess_engine.WHITE_KING_SIDE
+            queen_side = rights & chess_engine.WHITE_QUEEN_SIDE
+            home_sq = 60
+        else:
+            king_side = rights & chess_engine.BLACK_KING_SIDE
+            queen_side = rights & chess_engine.BLACK_QUEEN_SIDE
+            home_sq = 4
+        if king_sq != home_sq:
+            return
+        rooks = self.pieces[ally_color + 'R']
+        start_sq = divmod(king_sq, 8)
+        if king_side and rooks >> (king_sq + 3) & 1 and not occupied & (0b11 << (king_sq + 1)):
+            if not self.attackers_to(king_sq + 1, enemy_color, occupied) and \
+                    not self.attackers_to(king_sq + 2, enemy_color, occupied):
+                moves.append(chess_engine.Move(start_sq, divmod(king_sq + 2, 8), self.board, is_castle_move=True))
+        if queen_side and rooks >> (king_sq - 4) & 1 and not occupied & (0b111 << (king_sq - 3)):
+            if not self.attackers_to(king_sq - 1, enemy_color, occupied) and \
+                    not self.attackers_to(king_sq - 2, enemy_color, occupied):
+                moves.append(chess_engine.Move(start_sq, divmod(king_sq - 2, 8), self.board, is_castle_move=True))
@@ -1,24 +1,101 @@
+import random
+
+import evaluation
+
+# Zobrist keys: one random 64-bit number for every piece on every square, for the side to move,
+# for each of the 16 combinations of castling rights and for the en-passant file.
+# The generator is seeded so every process computes the same keys for the same position.
+_zobrist_random = random.Random(20220121)
+ZOBRIST_PIECES = {
+    color + piece_type: [_zobrist_random.getrandbits(64) for _ in range(64)]
+    for color in 'wb' for piece_type in 'PNBRQK'
+}
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(16)]
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]
+
+# Piece codes used by GameState.to_bytes, the index in this tuple is the byte stored for a square.
+PIECE_CODES = ('--', 'wP', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bP', 'bN', 'bB', 'bR', 'bQ', 'bK')
+PIECE_CODE_INDEX = {piece: i for i, piece in enumerate(PIECE_CODES)}
+NO_EN_PASSANT = 64
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+FEN_PIECES = {piece[1] if piece[0] == 'w' else piece[1].lower(): piece for piece in PIECE_CODES[1:]}
+PIECE_FEN = {piece: char for char, piece in FEN_PIECES.items()}
+
+# Castling rights are kept as a 4-bit number, the same numbering CastleRights.to_index uses.
+WHITE_KING_SIDE = 1
+BLACK_KING_SIDE = 2
+WHITE_QUEEN_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+ALL_CASTLING_RIGHTS = 15
+# A move from or to one of these squares takes away the castling rights of the king or rook that starts there.
+CASTLING_MASKS = [ALL_CASTLING_RIGHTS] * 64
+CASTLING_MASKS[0] &= ~BLACK_QUEEN_SIDE
+CASTLING_MASKS[4] &= ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE)
+CASTLING_MASKS[7] &= ~BLACK_KING_SIDE
+CASTLING_MASKS[56] &= ~WHITE_QUEEN_SIDE
+CASTLING_MASKS[60] &= ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+CASTLING_MASKS[63] &= ~WHITE_KING_SIDE
+# Initial number of entries of GameState.state_stack, it doubles whenever a game gets longer than that.
+STATE_STACK_SIZE = 256
+# A state stack entry holds, from the lowest bit: castling rights (4 bits), en-passant square (7),
+# captured piece code (4), halfmove clock (17), midgame and endgame score (20 each, shifted to be positive),
+# game phase (7) and above that the Zobrist key.
+STATE_SCORE_OFFSET = 1 << 19
+HALFMOVE_CLOCK_LIMIT = 1 << 17
+STATE_KEY_SHIFT = 79
+MIDGAME_SCORES = evaluation.MIDGAME_SCORES
+ENDGAME_SCORES = evaluation.ENDGAME_SCORES
+PIECE_PHASES = evaluation.PIECE_PHASES
+ALL_SQUARES = tuple((row, col) for row in range(8) for col in range(8))
+# Rough piece values, only used to put captures in a sensible order.
+ORDER_VALUES = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 10}
+
+
+def mvv_lva(move):
+    """
+    Sort key for captures: most valuable victim first, least valuable attacker as the tie breaker.
+    """
+    return ORDER_VALUES[move.piece_moved[1]] - 16 * ORDER_VALUES[move.piece_captured[1]]
+
+
+def _targets(offsets):
+    """
+    For every square, the squares a piece with the given single-step offsets can reach.
+    """
+    return [[tuple((row + d_row, col + d_col) for d_row, d_col in offsets
+                   if 0 <= row + d_row < 8 and 0 <= col + d_col < 8)
+             for col in range(8)] for row in range(8)]
+
+
+def _rays(directions):
+    """
+    For every square, the lines of squares going out of it in the given directions, nearest square first.
+    """
+    rays = [[[] for col in range(8)] for row in range(8)]
+    for row in range(8):
+        for col in range(8):
+            for d_row, d_col in directions:
+                ray = tuple((row + d_row * i, col + d_col * i) for i in range(1, 8)
+                            if 0 <= row + d_row * i < 8 and 0 <= col + d_col * i < 8)
+                if ray:
+                    rays[row][col].append(ray)
+    return rays
+
+
+KNIGHT_TARGETS = _targets(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+KING_TARGETS = _targets(((1, 0), (1, 1), (1, -1), (-1, 0), (-1, 1), (-1, -1), (0, 1), (0, -1)))
+ORTHOGONAL_RAYS = _rays(((-1, 0), (0, -1), (1, 0), (0, 1)))
+DIAGONAL_RAYS = _rays(((-1, -1), (-1, 1), (1, -1), (1, 1)))
+
+
 class GameState:
     """
     This class is responsible for storing all the information about the current state of a chess game. It will also be
     responsible for determining the valid moves at the current state. It will also keep a move log.
     """
 
-    def __init__(self):
-        # The board is 8x8 2d list, each element of a list has 2 characters.
-        # The first character represents the color of the piece, 'b' or 'w'
-        # The second character represents the type of the piece, 'K', 'Q', 'R', 'B', 'N' or 'P'
-        # "--" represents an empty space with no piece.
-        self.board = [
-            ['bR', 'bN', 'bB', 'bQ', 'bK', 'bB', 'bN', 'bR'],
-            ['bP', 'bP', 'bP', 'bP', 'bP', 'bP', 'bP', 'bP'],
-            ['--', '--', '--', '--', '--', '--', '--', '--'],
-            ['--', '--', '--', '--', '--', '--', '--', '--'],
-            ['--', '--', '--', '--', '--', '--', '--', '--'],
-            ['--', '--', '--', '--', '--', '--', '--', '--'],
-            ['wP', 'wP', 'wP', 'wP', 'wP', 'wP', 'wP', 'wP'],
-            ['wR', 'wN', 'wB', 'wQ', 'wK', 'wB', 'wN', 'wR']
-        ]
+    def __init__(self, fen=START_FEN):
         self.move_functions = {
             'P': self.get_pawn_moves,
             'R': self.get_rook_moves,
@@ -27,59 +104,373 @@ class GameState:
             'Q': self.get_queen_moves,
             'K': self.get_king_moves,
         }
-        self.white_to_move = True
-        self.move_log = []
-        self.white_king_location = (7, 4)
-        self.black_king_location = (0, 4)
         self.pins = []
         self.checks = []
+        self.in_check = False
+        # An optional move_cache.MoveCache that get_valid_moves asks first, it can be shared between games.
+        self.move_cache = None
+        # The board is 8x8 2d list, each element of a list has 2 characters.
+        # The first character represents the color of the piece, 'b' or 'w'
+        # The second character represents the type of the piece, 'K', 'Q', 'R', 'B', 'N' or 'P'
+        # "--" represents an empty space with no piece.
+        self.set_fen(fen)
+
+    def set_position(self, board, white_to_move, castling_rights, en_passant_possible=(), halfmove_clock=0,
+                     fullmove_number=1):
+        """
+        Replace the current position with the given one and forget the move log.
+        The board list is used as it is, not copied.
+        """
+        self.board = board
+        self.white_to_move = white_to_move
+        for row in range(8):
+            for col in range(8):
+                if board[row][col] == 'wK':
+                    self.white_king_location = (row, col)
+                elif board[row][col] == 'bK':
+                    self.black_king_location = (row, col)
+        self.move_log = []
         self.check_mate = False
         self.stale_mate = False
-        self.en_passant_possible = ()
-        self.current_castling_rights = CastleRights(True, True, True, True)
-        self.castle_rights_log = [CastleRights(self.current_castling_rights.wks, self.current_castling_rights.bks,
-                                   self.current_castling_rights.wqs, self.current_castling_rights.bqs)]
+        self.draw = None
+        self.en_passant_possible = en_passant_possible
+        self.castling_rights = castling_rights.to_index()
+        self.halfmove_clock = halfmove_clock
+        self.first_fullmove_number = fullmove_number
+        self.white_moved_first = white_to_move
+        # One packed number per move made, holding what undo_move can not work out from the move itself.
+        self.state_stack = [0] * STATE_STACK_SIZE
+        self.state_ply = 0
+        self.zobrist_key = self.compute_zobrist_key()
+        # How many times every position of the game has been on the board, by Zobrist key.
+        self.position_counts = {self.zobrist_key: 1}
+        # White's midgame and endgame piece-square sums and the game phase, kept up to date move by move.
+        self.midgame_score, self.endgame_score, self.phase = evaluation.compute_scores(board)
+
+    @property
+    def current_castling_rights(self):
+        """
+        The castling rights as a CastleRights object. It is a copy, change castling_rights to change them.
+        """
+        return CastleRights.from_index(self.castling_rights)
+
+    @classmethod
+    def from_fen(cls, fen):
+        """
+        Create a game from a FEN string. The position is set up directly, no moves are replayed.
+        """
+        return cls(fen)
+
+    def set_fen(self, fen):
+        """
+        Replace the current position with the one of a FEN string. The halfmove clock and the move number
+        may be left out. Raises ValueError when the string is not a valid FEN.
+        """
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError(f'FEN needs at least 4 fields: {fen!r}')
+        ranks = fields[0].split('/')
+        if len(ranks) != 8 or fields[1] not in ('w', 'b'):
+            raise ValueError(f'Invalid FEN: {fen!r}')
+        board = []
+        for rank in ranks:
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row.extend(['--'] * int(char))
+                elif char in FEN_PIECES:
+                    row.append(FEN_PIECES[char])
+                else:
+                    raise ValueError(f'Invalid piece {char!r} in FEN: {fen!r}')
+            if len(row) != 8:
+                raise ValueError(f'Rank {rank!r} does not have 8 squares in FEN: {fen!r}')
+            board.append(row)
+        for king in ('wK', 'bK'):
+            if sum(row.count(king) for row in board) != 1:
+                raise ValueError(f'FEN needs exactly one {"white" if king == "wK" else "black"} king: {fen!r}')
+        if any(piece[1] == 'P' for piece in board[0] + board[7]):
+            raise ValueError(f'FEN has a pawn on the first or last rank: {fen!r}')
+        castling = fields[2]
+        # A right is only kept while its king and rook are still on their starting squares.
+        for char, row, rook_col, color in (('K', 7, 7, 'w'), ('Q', 7, 0, 'w'), ('k', 0, 7, 'b'), ('q', 0, 0, 'b')):
+            if board[row][4] != color + 'K' or board[row][rook_col] != color + 'R':
+                castling = castling.replace(char, '')
+        en_passant_possible = ()
+        if fields[3] != '-':
+            if len(fields[3]) != 2 or fields[3][0] not in Move.files_to_cols or fields[3][1] != '63'[fields[1] == 'b']:
+                raise ValueError(f'Invalid en-passant square in FEN: {fen!r}')
+            row, col = Move.ranks_to_rows[fields[3][1]], Move.files_to_cols[fields[3][0]]
+            # Like a castling right, the square is only kept when a pawn has just moved two squares past it.
+            pawn_row, start_row, pawn = (row + 1, row - 1, 'bP') if fields[1] == 'w' else (row - 1, row + 1, 'wP')
+            if board[pawn_row][col] == pawn and board[row][col] == '--' and board[start_row][col] == '--':
+                en_passant_possible = (row, col)
+        halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        if not 0 <= halfmove_clock < HALFMOVE_CLOCK_LIMIT:
+            raise ValueError(f'Halfmove clock out of range in FEN: {fen!r}')
+        # Puzzle collections often write the move number as 0, it only matters for to_fen.
+        fullmove_number = max(1, int(fields[5])) if len(fields) > 5 else 1
+        self.set_position(board, fields[1] == 'w',
+                          CastleRights('K' in castling, 'k' in castling, 'Q' in castling, 'q' in castling),
+                          en_passant_possible, halfmove_clock, fullmove_number)
+        return self
+
+    def to_fen(self):
+        """
+        The current position as a FEN string.
+        """
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for piece in row:
+                if piece == '--':
+                    empty += 1
+                else:
+                    if empty:
+                        rank += str(empty)
+                        empty = 0
+                    rank += PIECE_FEN[piece]
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+        castling = ''.join(char for char, bit in (('K', WHITE_KING_SIDE), ('Q', WHITE_QUEEN_SIDE),
+                                                  ('k', BLACK_KING_SIDE), ('q', BLACK_QUEEN_SIDE))
+                           if self.castling_rights & bit) or '-'
+        if self.en_passant_possible == ():
+            en_passant = '-'
+        else:
+            en_passant = Move.cols_to_files[self.en_passant_possible[1]] + Move.row_to_ranks[self.en_passant_possible[0]]
+        # Moves are numbered from white's move, a game that started with black to move is one half move ahead.
+        plies = len(self.move_log) + (0 if self.white_moved_first else 1)
+        fullmove_number = self.first_fullmove_number + plies // 2
+        return (f'{"/".join(ranks)} {"w" if self.white_to_move else "b"} {castling} {en_passant} '
+                f'{self.halfmove_clock} {fullmove_number}')
+
+    def parse_san(self, san):
+        """
+        Find the legal move written in standard algebraic notation, like 'Nbd7', 'exd5', 'e8=Q+' or 'O-O'.
+        A pawn reaching the last rank without a promotion piece promotes to a queen.
+        Raises ValueError when no legal move or more than one matches.
+        """
+        text = san.rstrip('+#!?')
+        moves = self.get_valid_moves()
+        if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+            king_side = len(text) == 3
+            matches = [move for move in moves if move.is_castle_move and (move.end_col > move.start_col) == king_side]
+        else:
+            promotion_piece = 'Q'
+            if '=' in text:
+                text, promotion_piece = text.split('=', 1)
+            elif text and text[-1] in 'QRBN' and text[0] in Move.files_to_cols:
+                text, promotion_piece = text[:-1], text[-1]
+            piece = 'P'
+            if text and text[0] in 'KQRBN':
+                piece, text = text[0], text[1:]
+            text = text.replace('x', '').replace('-', '')
+            if len(text) < 2 or text[-2] not in Move.files_to_cols or text[-1] not in Move.ranks_to_rows:
+                raise ValueError(f'Invalid SAN move: {san!r}')
+            end_row, end_col = Move.ranks_to_rows[text[-1]], Move.files_to_cols[text[-2]]
+            from_square = text[:-2]
+            matches = []
+            for move in moves:
+                if move.piece_moved[1] != piece or move.end_row != end_row or move.end_col != end_col:
+                    continue
+                if move.is_pawn_promotion and move.promotion_piece != promotion_piece:
+                    continue
+                start = move.gat_rank_file(move.start_row, move.start_col)
+                if all(char in start for char in from_square):
+                    matches.append(move)
+        if len(matches) != 1:
+            raise ValueError(f'{"Ambiguous" if matches else "Illegal"} SAN move {san!r} in {self.to_fen()}')
+        return matches[0]
+
+    def move_to_san(self, move):
+        """
+        Write a legal move of the current position in standard algebraic notation, the way parse_san reads it.
+        """
+        if move.is_castle_move:
+            san = 'O-O' if move.end_col > move.start_col else 'O-O-O'
+        else:
+            target = move.gat_rank_file(move.end_row, move.end_col)
+            capture = 'x' if move.piece_captured != '--' else ''
+            if move.piece_moved[1] == 'P':
+                san = (Move.cols_to_files[move.start_col] + capture if capture else '') + target
+                if move.is_pawn_promotion:
+                    san += '=' + move.promotion_piece
+            else:
+                # Other pieces of the same kind that can go to the same square decide what the start has to say.
+                others = [other for other in self.legal_moves() if other.piece_moved == move.piece_moved
+                          and other.end_row == move.end_row and other.end_col == move.end_col
+                          and (other.start_row, other.start_col) != (move.start_row, move.start_col)]
+                start = ''
+                if others:
+                    if all(other.start_col != move.start_col for other in others):
+                        start = Move.cols_to_files[move.start_col]
+                    elif all(other.start_row != move.start_row for other in others):
+                        start = Move.row_to_ranks[move.start_row]
+                    else:
+                        start = move.gat_rank_file(move.start_row, move.start_col)
+                san = move.piece_moved[1] + start + capture + target
+        self.make_move(move)
+        if self.sq_in_check():
+            san += '+' if self.has_legal_move() else '#'
+        self.undo_move()
+        return san
+
+    def to_bytes(self):
+        """
+        Pack the position into 67 bytes: one piece code per square, the side to move,
+        the castling rights and the en-passant square. The move log is not included.
+        """
+        data = bytearray(PIECE_CODE_INDEX[piece] for row in self.board for piece in row)
+        data.append(self.white_to_move)
+        data.append(self.castling_rights)
+        if self.en_passant_possible == ():
+            data.append(NO_EN_PASSANT)
+        else:
+            data.append(self.en_passant_possible[0] * 8 + self.en_passant_possible[1])
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Create a game from the output of to_bytes.
+        """
+        gs = cls()
+        gs.set_bytes(data)
+        return gs
+
+    def set_bytes(self, data, halfmove_clock=0, fullmove_number=1):
+        """
+        Replace the current position with the output of to_bytes, which leaves out the move counters.
+        """
+        board = [[PIECE_CODES[code] for code in data[row*8:row*8+8]] for row in range(8)]
+        en_passant_possible = () if data[66] == NO_EN_PASSANT else divmod(data[66], 8)
+        self.set_position(board, bool(data[64]), CastleRights.from_index(data[65]), en_passant_possible,
+                          halfmove_clock, fullmove_number)
+
+    def compute_zobrist_key(self):
+        """
+        Compute the Zobrist key of the position from scratch.
+        make_move and undo_move keep self.zobrist_key up to date, so this is only needed for a new position.
+        """
+        key = 0
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece != '--':
+                    key ^= ZOBRIST_PIECES[piece][row * 8 + col]
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        return key ^ self.en_passant_zobrist_key()
+
+    def en_passant_zobrist_key(self):
+        """
+        The en-passant file is only part of the key when a pawn of the side to move stands next to the
+        pawn that just moved, so positions that only differ by an unusable en-passant square hash the same.
+        """
+        if self.en_passant_possible == ():
+            return 0
+        row, col = self.en_passant_possible
+        pawn_row = row + 1 if self.white_to_move else row - 1
+        ally_pawn = 'wP' if self.white_to_move else 'bP'
+        if (col > 0 and self.board[pawn_row][col-1] == ally_pawn) or \
+                (col < 7 and self.board[pawn_row][col+1] == ally_pawn):
+            return ZOBRIST_EN_PASSANT[col]
+        return 0
       
     def make_move(self, move):
         """
-        Takes a Move as a parameter and executes it 
-        (this will not work for castling, pawn promotion and en-passant).
+        Takes a Move as a parameter and executes it. The promotion piece comes with the move.
+        What can not be worked out from the move again (castling rights, en-passant square, captured piece,
+        halfmove clock) is pushed as one packed number on the state stack for undo_move, together with
+        the Zobrist key and evaluation sums, which are updated here piece by piece instead of recomputed.
         """
-        self.board[move.start_row][move.start_col] = "--"
-        self.board[move.end_row][move.end_col] = move.piece_moved
+        board = self.board
+        start_row, start_col, end_row, end_col = move.start_row, move.start_col, move.end_row, move.end_col
+        piece_moved = move.piece_moved
+        piece_captured = move.piece_captured
+        rights = self.castling_rights
+        en_passant = NO_EN_PASSANT if self.en_passant_possible == () else \
+            self.en_passant_possible[0] * 8 + self.en_passant_possible[1]
+        if self.state_ply == len(self.state_stack):
+            self.state_stack.extend([0] * len(self.state_stack))
+        midgame, endgame, phase = self.midgame_score, self.endgame_score, self.phase
+        self.state_stack[self.state_ply] = rights | en_passant << 4 | PIECE_CODE_INDEX[piece_captured] << 11 | \
+            (self.halfmove_clock & 0x1ffff) << 15 | (midgame + STATE_SCORE_OFFSET) << 32 | \
+            (endgame + STATE_SCORE_OFFSET) << 52 | phase << 72 | self.zobrist_key << STATE_KEY_SHIFT
+        self.state_ply += 1
+
+        start_sq = start_row * 8 + start_col
+        end_sq = end_row * 8 + end_col
+        key = self.zobrist_key ^ self.en_passant_zobrist_key() ^ ZOBRIST_BLACK_TO_MOVE ^ ZOBRIST_CASTLING[rights]
+        key ^= ZOBRIST_PIECES[piece_moved][start_sq]
+        midgame -= MIDGAME_SCORES[piece_moved][start_sq]
+        endgame -= ENDGAME_SCORES[piece_moved][start_sq]
+        if piece_captured != '--' and not move.is_en_passant_move:
+            key ^= ZOBRIST_PIECES[piece_captured][end_sq]
+            midgame -= MIDGAME_SCORES[piece_captured][end_sq]
+            endgame -= ENDGAME_SCORES[piece_captured][end_sq]
+            phase -= PIECE_PHASES[piece_captured]
+        board[start_row][start_col] = "--"
+        board[end_row][end_col] = piece_moved
         self.move_log.append(move)
         # Swap players
         self.white_to_move = not self.white_to_move
-        if move.piece_moved == 'wk':
-            self.white_king_location = (move.end_row, move.end_col)
-        elif move.piece_moved == 'bK':
-            self.black_king_location = (move.end_row, move.end_col)
+        if piece_moved == 'wK':
+            self.white_king_location = (end_row, end_col)
+        elif piece_moved == 'bK':
+            self.black_king_location = (end_row, end_col)
         
         if move.is_pawn_promotion:
-            promoted_piece = input('Promote to Q, R, B or N: ')
-            self.board[move.end_row][move.end_col] = move.piece_moved[0] + promoted_piece
+            piece_placed = piece_moved[0] + move.promotion_piece
+            board[end_row][end_col] = piece_placed
+            phase += PIECE_PHASES[piece_placed]
+        else:
+            piece_placed = piece_moved
         
         if move.is_en_passant_move:
-            self.board[move.start_row][move.end_col] = '--'
+            board[start_row][end_col] = '--'
+            key ^= ZOBRIST_PIECES[piece_captured][start_row * 8 + end_col]
+            midgame -= MIDGAME_SCORES[piece_captured][start_row * 8 + end_col]
+            endgame -= ENDGAME_SCORES[piece_captured][start_row * 8 + end_col]
+        key ^= ZOBRIST_PIECES[piece_placed][end_sq]
+        midgame += MIDGAME_SCORES[piece_placed][end_sq]
+        endgame += ENDGAME_SCORES[piece_placed][end_sq]
 
-        if move.piece_moved[1] == 'P' and abs(move.start_row-move.end_row) == 2:
-            self.en_passant_possible = ((move.start_row+move.end_row) // 2, move.start_col)
+        if piece_moved[1] == 'P' and abs(start_row-end_row) == 2:
+            self.en_passant_possible = ((start_row+end_row) // 2, start_col)
         else:
             self.en_passant_possible = ()
         
         # Castling
         if move.is_castle_move:
-            if move.end_col - move.start_col == 2:
-                self.board[move.end_row][move.end_col-1] = self.board[move.end_row][move.end_col+1]
-                self.board[move.end_row][move.end_col+1] = '--'
+            if end_col - start_col == 2:
+                rook_from, rook_to = end_col+1, end_col-1
             else:
-                self.board[move.end_row][move.end_col+1] = self.board[move.end_row][move.end_col-2]
-                self.board[move.end_row][move.end_col-2] = '--'
+                rook_from, rook_to = end_col-2, end_col+1
+            rook = board[end_row][rook_from]
+            board[end_row][rook_to] = rook
+            board[end_row][rook_from] = '--'
+            key ^= ZOBRIST_PIECES[rook][end_row * 8 + rook_from] ^ ZOBRIST_PIECES[rook][end_row * 8 + rook_to]
+            midgame += MIDGAME_SCORES[rook][end_row * 8 + rook_to] - MIDGAME_SCORES[rook][end_row * 8 + rook_from]
+            endgame += ENDGAME_SCORES[rook][end_row * 8 + rook_to] - ENDGAME_SCORES[rook][end_row * 8 + rook_from]
+        self.midgame_score, self.endgame_score, self.phase = midgame, endgame, phase
+
+        # Pawn moves and captures can not be taken back, they reset the fifty-move count
+        if piece_moved[1] == 'P' or piece_captured != '--':
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
         
-        # Update the castle rights whenever it is a Rook or a King move.
-        self.update_castle_rights(move)
-        self.castle_rights_log.append(CastleRights(self.current_castling_rights.wks, self.current_castling_rights.bks,
-                            self.current_castling_rights.wqs, self.current_castling_rights.bqs))
+        # Every king or rook move and every capture on a rook corner can take away castle rights.
+        rights &= CASTLING_MASKS[start_sq] & CASTLING_MASKS[end_sq]
+        self.castling_rights = rights
+        key ^= ZOBRIST_CASTLING[rights]
+        key ^= self.en_passant_zobrist_key()
+        self.zobrist_key = key
+        self.position_counts[key] = self.position_counts.get(key, 0) + 1
     
     def undo_move(self):
         """
@@ -88,103 +479,207 @@ class GameState:
         if len(self.move_log) == 0:
             return
         last_move = self.move_log.pop()
-        self.board[last_move.start_row][last_move.start_col] = last_move.piece_moved
-        self.board[last_move.end_row][last_move.end_col] = last_move.piece_captured
+        count = self.position_counts[self.zobrist_key]
+        if count == 1:
+            del self.position_counts[self.zobrist_key]
+        else:
+            self.position_counts[self.zobrist_key] = count - 1
+        self.state_ply -= 1
+        state = self.state_stack[self.state_ply]
+        self.castling_rights = state & 15
+        en_passant = (state >> 4) & 127
+        self.en_passant_possible = () if en_passant == NO_EN_PASSANT else divmod(en_passant, 8)
+        piece_captured = PIECE_CODES[(state >> 11) & 15]
+        self.halfmove_clock = (state >> 15) & 0x1ffff
+        self.midgame_score = ((state >> 32) & 0xfffff) - STATE_SCORE_OFFSET
+        self.endgame_score = ((state >> 52) & 0xfffff) - STATE_SCORE_OFFSET
+        self.phase = (state >> 72) & 127
+        self.zobrist_key = state >> STATE_KEY_SHIFT
+
+        board = self.board
+        board[last_move.start_row][last_move.start_col] = last_move.piece_moved
+        board[last_move.end_row][last_move.end_col] = piece_captured
         # Swap players back
         self.white_to_move = not self.white_to_move
         # Set back kings lovation
-        if last_move.piece_moved == 'wk':
+        if last_move.piece_moved == 'wK':
             self.white_king_location = (last_move.start_row, last_move.start_col)
         elif last_move.piece_moved == 'bK':
             self.black_king_location = (last_move.start_row, last_move.start_col)
-        # Make en-passant possible again
+        # Put back the pawn taken en-passant
         if last_move.is_en_passant_move:
-            self.board[last_move.end_row][last_move.end_col] = '--'
-            self.board[last_move.start_row][last_move.end_col] = last_move.piece_captured
-            self.en_passant_possible = (last_move.end_row, last_move.end_col)
-        if last_move.piece_moved[1] == 'P' and abs(last_move.start_row-last_move.end_row) == 2:
-            self.en_passant_possible = ()
-        # Set back castle rights
-        self.castle_rights_log.pop()
-        self.current_castling_rights = self.castle_rights_log[-1]
+            board[last_move.end_row][last_move.end_col] = '--'
+            board[last_move.start_row][last_move.end_col] = piece_captured
         # Reset the rook if last move was castling
         if last_move.is_castle_move:
             if last_move.end_col - last_move.start_col == 2:
-                self.board[last_move.end_row][last_move.end_col+1] = self.board[last_move.end_row][last_move.end_col-1]
-                self.board[last_move.end_row][last_move.end_col-1] = '--'
+                board[last_move.end_row][last_move.end_col+1] = board[last_move.end_row][last_move.end_col-1]
+                board[last_move.end_row][last_move.end_col-1] = '--'
             else:
-                self.board[last_move.end_row][last_move.end_col-2] = self.board[last_move.end_row][last_move.end_col+1]
-                self.board[last_move.end_row][last_move.end_col+1] = '--'
-        print(f'Undo the move: {last_move.get_chess_notation()}')
-    
-    def update_castle_rights(self, move):
-        if move.piece_moved == 'wK':
-            self.current_castling_rights.wks = False
-            self.current_castling_rights.wqs = False
-        elif move.piece_moved == 'bK':
-            self.current_castling_rights.bks = False
-            self.current_castling_rights.wqs = False
-        elif move.piece_moved == 'wR':
-            if move.start_row == 7:
-                if move.start_col == 0:
-                    self.current_castling_rights.wqs = False
-                elif move.start_col == 7:
-                    self.current_castling_rights.wks = False
-        elif move.piece_moved == 'bR':
-            if move.start_row == 0:
-                if move.start_col == 0:
-                    self.current_castling_rights.bqs = False
-                elif move.start_col == 7:
-                    self.current_castling_rights.bks = False
+                board[last_move.end_row][last_move.end_col-2] = board[last_move.end_row][last_move.end_col+1]
+                board[last_move.end_row][last_move.end_col+1] = '--'
     
     def get_valid_moves(self):
         """
-        All moves considering checks
+        All moves considering checks. This also sets check_mate, stale_mate and draw for the GUI,
+        use legal_moves or iter_moves when the position should only be looked at.
         """
-        moves = []
-        self.in_check, self.pins, self.checks = self.check_for_pins_and_checks()
-        if self.white_to_move:
-            king_row = self.white_king_location[0]
-            king_col = self.white_king_location[1]
+        if self.move_cache is None:
+            moves = self.legal_moves()
         else:
-            king_row = self.black_king_location[0]
-            king_col = self.black_king_location[1]
-        if self.in_check:
-            if len(self.checks) == 1:
-                moves = self.get_all_possible_moves()
-                check = self.checks[0]
-                check_row = check[0]
-                check_col = check[1]
-                piece_checking = self.board[check_row][check_col]
-                valid_squares = []
-                if piece_checking[1] == 'N':
-                    valid_squares = [(check_row, check_col)]
+            moves = self.move_cache.legal_moves(self)
+        self.check_mate = len(moves) == 0 and self.in_check
+        self.stale_mate = len(moves) == 0 and not self.in_check
+        # A mate on the move that reaches the fifty-move limit still counts, so a draw needs a legal move.
+        self.draw = self.draw_reason() if moves else None
+        return moves
+
+    def is_repetition(self, times=3):
+        """
+        True when the current position has been on the board at least this many times.
+        A dict lookup, the move log is never scanned.
+        """
+        return self.position_counts[self.zobrist_key] >= times
+
+    def is_fifty_moves(self):
+        return self.halfmove_clock >= 100
+
+    def is_insufficient_material(self):
+        """
+        True when neither side can mate: bare kings, a single minor piece or only bishops on one square colour.
+        """
+        # Any rook or queen, or more than two minor pieces, is enough to go on. Checked without looking at the board.
+        if self.phase > 2:
+            return False
+        bishop_square_colors = set()
+        minor_pieces = 0
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece == '--' or piece[1] == 'K':
+                    continue
+                if piece[1] in 'PRQ':
+                    return False
+                minor_pieces += 1
+                if piece[1] == 'B':
+                    bishop_square_colors.add((row + col) % 2)
                 else:
-                    for i in range(1, 8):
-                        valid_square = (king_row + check[2] * i, king_col + check[3] * i)
-                        valid_squares.append(valid_square)
-                        if valid_square[0] == check_row and valid_square[1] == check_col:
-                            break
-                for i in range(len(moves)-1, -1, -1):
-                    if moves[i].piece_moved[1] != 'K':
-                        if not (moves[i].end_row, moves[i].end_col) in valid_squares:
-                            moves.remove(moves[i])
-            else:
-                self.get_king_moves(king_row, king_col, moves)
+                    bishop_square_colors.add(None)
+        return minor_pieces <= 1 or (None not in bishop_square_colors and len(bishop_square_colors) == 1)
+
+    def draw_reason(self):
+        """
+        'threefold repetition', 'fifty-move rule', 'insufficient material' or None.
+        Stalemate is not included, it is reported by stale_mate.
+        """
+        if self.is_repetition():
+            return 'threefold repetition'
+        if self.is_fifty_moves():
+            return 'fifty-move rule'
+        if self.is_insufficient_material():
+            return 'insufficient material'
+        return None
+
+    def legal_moves(self):
+        """
+        All moves considering checks, without touching check_mate and stale_mate.
+        """
+        return list(self.generate_legal_moves())
+
+    def has_legal_move(self):
+        """
+        True when the side to move has any legal move. Generation stops at the first one found.
+        """
+        for _ in self.generate_legal_moves():
+            return True
+        return False
+
+    def generate_legal_moves(self, squares=ALL_SQUARES):
+        """
+        Yield the legal moves one piece at a time in board order, so only the pieces the caller gets to
+        are looked at. squares limits the generation to the pieces standing on those squares.
+        Moves can be made and undone between two steps, the generator keeps its own pins and checks.
+        """
+        in_check, pins, checks = self.check_for_pins_and_checks()
+        self.in_check = in_check
+        if self.white_to_move:
+            ally_color = 'w'
+            king_row, king_col = self.white_king_location
         else:
-            moves = self.get_all_possible_moves()
-            if self.white_to_move:
-                self.get_castle_moves(self.white_king_location[0], self.white_king_location[1], moves)
+            ally_color = 'b'
+            king_row, king_col = self.black_king_location
+        if len(checks) > 1:
+            # Double check, only the king can move
+            if (king_row, king_col) in squares:
+                moves = []
+                self.get_king_moves(king_row, king_col, moves)
+                yield from moves
+            return
+        if in_check:
+            check_row, check_col, d_row, d_col = checks[0]
+            if self.board[check_row][check_col][1] == 'N':
+                valid_squares = {(check_row, check_col)}
             else:
-                self.get_castle_moves(self.black_king_location[0], self.black_king_location[1], moves)
+                valid_squares = set()
+                for i in range(1, 8):
+                    valid_square = (king_row + d_row * i, king_col + d_col * i)
+                    valid_squares.add(valid_square)
+                    if valid_square[0] == check_row and valid_square[1] == check_col:
+                        break
+        board = self.board
+        for row, col in squares:
+            piece = board[row][col]
+            if piece[0] != ally_color:
+                continue
+            piece_moves = []
+            self.pins = pins
+            self.move_functions[piece[1]](row, col, piece_moves)
+            if not in_check:
+                yield from piece_moves
+                continue
+            # Keep king moves, moves that block or capture the checking piece and en-passant
+            # taking the checking pawn from the square next to the capturing pawn.
+            for move in piece_moves:
+                if move.piece_moved[1] == 'K' or (move.end_row, move.end_col) in valid_squares or \
+                        (move.is_en_passant_move and (move.start_row, move.end_col) == (check_row, check_col)):
+                    yield move
+        if not in_check and (king_row, king_col) in squares:
+            moves = []
+            self.in_check = False
+            self.get_castle_moves(king_row, king_col, moves)
+            yield from moves
 
-        if len(moves) == 0:
-            if self.in_check:
-                self.check_mate = True
-            else:
-                self.stale_mate = True
-        
-        return moves
+    def iter_moves(self, hash_move_id=None, captures_only=False):
+        """
+        Yield the legal moves lazily in stages: the hash move first, then captures with the most valuable
+        victim and least valuable attacker first, then promotions and finally the quiet moves.
+        The hash move is checked by generating the moves of its piece only, so a cutoff on it costs
+        no full generation. With captures_only the quiet moves are left out.
+        Nothing but in_check is changed on the GameState.
+        """
+        if hash_move_id is not None:
+            start_sq = ((hash_move_id >> 3) & 7, hash_move_id & 7)
+            for move in self.generate_legal_moves((start_sq,)):
+                if move.move_id == hash_move_id:
+                    if not captures_only or move.piece_captured != '--' or move.is_pawn_promotion:
+                        yield move
+                    break
+        captures = []
+        promotions = []
+        quiet_moves = []
+        for move in self.generate_legal_moves():
+            if move.move_id == hash_move_id:
+                continue
+            if move.piece_captured != '--':
+                captures.append(move)
+            elif move.is_pawn_promotion:
+                promotions.append(move)
+            elif not captures_only:
+                quiet_moves.append(move)
+        captures.sort(key=mvv_lva)
+        yield from captures
+        yield from promotions
+        yield from quiet_moves
 
     def get_all_possible_moves(self):
         """
@@ -212,12 +707,37 @@ class GameState:
         """
         Determine if enemy can attack the square row col
         """
-        self.white_to_move = not self.white_to_move  # switch to opponent's point of view
-        opponents_moves = self.get_all_possible_moves()
-        self.white_to_move = not self.white_to_move
-        for move in opponents_moves:
-            if move.end_row == row and move.end_col == col:  # square is under attack
+        return self.is_square_attacked(row, col, 'b' if self.white_to_move else 'w')
+
+    def is_square_attacked(self, row, col, enemy_color):
+        """
+        Look outwards from the square for an enemy piece that attacks it and stop at the first one found.
+        This never generates moves, it only reads the board along the precomputed knight, king and ray squares.
+        """
+        board = self.board
+        enemy_knight = enemy_color + 'N'
+        for end_row, end_col in KNIGHT_TARGETS[row][col]:
+            if board[end_row][end_col] == enemy_knight:
+                return True
+        enemy_king = enemy_color + 'K'
+        for end_row, end_col in KING_TARGETS[row][col]:
+            if board[end_row][end_col] == enemy_king:
+                return True
+        # White pawns capture towards row 0, so they attack a square from the row below it.
+        pawn_row = row + 1 if enemy_color == 'w' else row - 1
+        if 0 <= pawn_row < 8:
+            enemy_pawn = enemy_color + 'P'
+            if (col > 0 and board[pawn_row][col-1] == enemy_pawn) or \
+                    (col < 7 and board[pawn_row][col+1] == enemy_pawn):
                 return True
+        for rays, sliders in ((ORTHOGONAL_RAYS, 'RQ'), (DIAGONAL_RAYS, 'BQ')):
+            for ray in rays[row][col]:
+                for end_row, end_col in ray:
+                    end_piece = board[end_row][end_col]
+                    if end_piece != '--':
+                        if end_piece[0] == enemy_color and end_piece[1] in sliders:
+                            return True
+                        break
         return False
     
     def get_pawn_moves(self, row, col, moves):
@@ -237,25 +757,55 @@ class GameState:
             move_amount = -1
             start_row = 6
             enemy_color = 'b'
+            king_row, king_col = self.white_king_location
         else:
             move_amount = 1
             start_row = 1
             enemy_color = 'w'
+            king_row, king_col = self.black_king_location
         capture_directions = [-1, 1]
 
 
         if self.board[row+move_amount][col] == '--':
-            if not piece_pinned or pin_direction == (move_amount, 0):
-                moves.append(Move((row, col), (row+move_amount, col), self.board))
+            # A pinned pawn can still move along the pin, whether the king is behind it or in front of it
+            if not piece_pinned or pin_direction == (move_amount, 0) or pin_direction == (-move_amount, 0):
+                self.add_pawn_move((row, col), (row+move_amount, col), moves)
                 if row == start_row and self.board[row+2*move_amount][col] == '--':
                     moves.append(Move((row, col), (row+2*move_amount, col), self.board))
         for d in capture_directions:
             if 0 <= col + d < 8:
-                if not piece_pinned or pin_direction == (move_amount, d):
+                if not piece_pinned or pin_direction == (move_amount, d) or pin_direction == (-move_amount, -d):
                     if self.board[row+move_amount][col+d][0] == enemy_color:
-                        moves.append(Move((row, col), (row+move_amount, col+d), self.board))
+                        self.add_pawn_move((row, col), (row+move_amount, col+d), moves)
                     elif (row+move_amount, col+d) == self.en_passant_possible:
-                        moves.append(Move((row, col), (row+move_amount, col+d), self.board, is_en_passant=True))
+                        if not (king_row == row and self.en_passant_exposes_king(row, col, col+d, king_col)):
+                            moves.append(Move((row, col), (row+move_amount, col+d), self.board, is_en_passant=True))
+
+    def add_pawn_move(self, start_sq, end_sq, moves):
+        """
+        Add a pawn move to the list, a move to the last rank is added once for every promotion piece.
+        """
+        if end_sq[0] == 0 or end_sq[0] == 7:
+            for promotion_piece in Move.promotion_pieces:
+                moves.append(Move(start_sq, end_sq, self.board, promotion_piece=promotion_piece))
+        else:
+            moves.append(Move(start_sq, end_sq, self.board))
+
+    def en_passant_exposes_king(self, row, col, capture_col, king_col):
+        """
+        En-passant takes two pawns off the king's row at once, which no pin can see.
+        Look along the row from the king past both pawns for an enemy rook or queen.
+        """
+        enemy_color = 'b' if self.white_to_move else 'w'
+        step = 1 if col > king_col else -1
+        end_col = king_col + step
+        while 0 <= end_col < 8:
+            if end_col != col and end_col != capture_col:
+                end_piece = self.board[row][end_col]
+                if end_piece != '--':
+                    return end_piece[0] == enemy_color and end_piece[1] in 'RQ'
+            end_col += step
+        return False
     
     def get_rook_moves(self, row, col, moves):
         """
@@ -360,38 +910,30 @@ class GameState:
         self.get_bishop_moves(row, col, moves)
 
     def get_king_moves(self, row, col, moves):
-        possible_moves = ((1, 0), (1, 1), (1, -1), (-1, 0), (-1, 1), (-1, -1), (0, 1), (0, -1))
         ally_color = 'w' if self.white_to_move else 'b'
-        for m in possible_moves:
-            end_row = row + m[0]
-            end_col = col + m[1]
-            if 0 <= end_row < 8 and 0 <= end_col < 8:
-                end_piece = self.board[end_row][end_col]
-                if end_piece[0] != ally_color:
-                    if ally_color == 'w':
-                        self.white_king_location = (end_row, end_col)
-                    else:
-                        self.black_king_location = (end_row, end_col)
-                    in_check, pins, checks = self.check_for_pins_and_checks()
-                    if not in_check:
-                        moves.append(
-                            Move(
-                                (row, col), 
-                                (end_row, end_col), 
-                                self.board))
-                    if ally_color == 'w':
-                        self.white_king_location = (row, col)
-                    else:
-                        self.black_king_location = (row, col)
+        enemy_color = 'b' if self.white_to_move else 'w'
+        king = self.board[row][col]
+        # Lift the king off its square, otherwise it would shield itself from a ray it walks along
+        self.board[row][col] = '--'
+        safe_squares = []
+        for end_row, end_col in KING_TARGETS[row][col]:
+            end_piece = self.board[end_row][end_col]
+            if end_piece[0] != ally_color:
+                if not self.is_square_attacked(end_row, end_col, enemy_color):
+                    safe_squares.append((end_row, end_col))
+        self.board[row][col] = king
+        # Move reads the moved piece from the board, so the moves are created once the king is back
+        for end_sq in safe_squares:
+            moves.append(Move((row, col), end_sq, self.board))
     
     def get_castle_moves(self, row, col, moves):
-        if self.square_under_attack(row, col):
+        # get_valid_moves has just found out whether we are in check
+        if self.in_check:
             return
-        if (self.white_to_move and self.current_castling_rights.wks) or (
-            not self.white_to_move and self.current_castling_rights.bks):
+        rights = self.castling_rights
+        if rights & (WHITE_KING_SIDE if self.white_to_move else BLACK_KING_SIDE):
             self.get_king_side_castle_moves(row, col, moves)
-        if (self.white_to_move and self.current_castling_rights.wqs) or (
-            not self.white_to_move and self.current_castling_rights.bqs):
+        if rights & (WHITE_QUEEN_SIDE if self.white_to_move else BLACK_QUEEN_SIDE):
             self.get_queen_side_castle_moves(row, col, moves)
 
     def get_king_side_castle_moves(self, row, col, moves):
@@ -478,8 +1020,25 @@ class CastleRights:
         self.wqs = wqs
         self.bqs = bqs
 
+    def to_index(self):
+        """
+        Number 0-15 for this combination of rights, used to pick the Zobrist key and to pack positions.
+        """
+        return self.wks | self.bks << 1 | self.wqs << 2 | self.bqs << 3
+
+    @classmethod
+    def from_index(cls, index):
+        return cls(bool(index & 1), bool(index & 2), bool(index & 4), bool(index & 8))
+
     
 class Move:
+    """
+    A move is identified by its move_id, a 16-bit number: bits 0-5 hold the start square (row * 8 + col),
+    bits 6-11 the end square and bits 12-13 the promotion piece. Moves use __slots__, so no per-instance
+    __dict__ is created for the many moves the generator produces.
+    """
+    __slots__ = ('start_row', 'start_col', 'end_row', 'end_col', 'piece_moved', 'piece_captured',
+                 'is_pawn_promotion', 'promotion_piece', 'is_en_passant_move', 'is_castle_move', 'move_id')
     ranks_to_rows = {
         "1": 7,
         "2": 6,
@@ -502,21 +1061,42 @@ class Move:
         "h": 7,
     }
     cols_to_files = {v: k for k, v in files_to_cols.items()}
+    promotion_pieces = ('Q', 'R', 'B', 'N')
+    promotion_index = {piece: i for i, piece in enumerate(promotion_pieces)}
 
-    def __init__(self, start_sq, end_sq, board, is_en_passant=False, is_castle_move=False):
-        self.start_row = start_sq[0]
-        self.start_col = start_sq[1]
-        self.end_row = end_sq[0]
-        self.end_col = end_sq[1]
-        self.piece_moved = board[self.start_row][self.start_col]
-        self.piece_captured = board[self.end_row][self.end_col]
-        self.is_pawn_promotion = ((self.piece_moved == 'wP' and self.end_row == 0) or \
-                (self.piece_moved == 'bP' and self.end_row == 7))
+    def __init__(self, start_sq, end_sq, board, is_en_passant=False, is_castle_move=False, promotion_piece='Q'):
+        start_row, start_col = start_sq
+        end_row, end_col = end_sq
+        self.start_row = start_row
+        self.start_col = start_col
+        self.end_row = end_row
+        self.end_col = end_col
+        piece_moved = board[start_row][start_col]
+        self.piece_moved = piece_moved
+        self.piece_captured = board[end_row][end_col]
+        self.is_pawn_promotion = piece_moved[1] == 'P' and (end_row == 0 or end_row == 7)
+        self.promotion_piece = promotion_piece
         self.is_en_passant_move = is_en_passant
-        if self.is_en_passant_move:
-            self.piece_captured = 'wP' if self.piece_moved == 'bP' else 'bP'
+        if is_en_passant:
+            self.piece_captured = 'wP' if piece_moved == 'bP' else 'bP'
         self.is_castle_move = is_castle_move
-        self.move_id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
+        self.move_id = start_row << 3 | start_col | end_row << 9 | end_col << 6
+        if self.is_pawn_promotion:
+            self.move_id |= self.promotion_index[promotion_piece] << 12
+
+    @classmethod
+    def from_id(cls, move_id, board):
+        """
+        Rebuild the Move with the given move_id for the position on the board.
+        Castling and en-passant are recognized from the pieces, like a move entered on the GUI.
+        """
+        start_row, start_col = (move_id >> 3) & 7, move_id & 7
+        end_row, end_col = (move_id >> 9) & 7, (move_id >> 6) & 7
+        piece_moved = board[start_row][start_col]
+        is_castle_move = piece_moved[1] == 'K' and abs(end_col - start_col) == 2
+        is_en_passant = piece_moved[1] == 'P' and start_col != end_col and board[end_row][end_col] == '--'
+        return cls((start_row, start_col), (end_row, end_col), board, is_en_passant=is_en_passant,
+                   is_castle_move=is_castle_move, promotion_piece=cls.promotion_pieces[move_id >> 12])
 
     def __eq__(self, other):
         """
@@ -525,6 +1105,9 @@ class Move:
         if isinstance(other, Move):
             return self.move_id == other.move_id
         return False
+
+    def __hash__(self):
+        return self.move_id
     
     def __repr__(self):
         return f'Move(start_pos: {self.start_row, self.start_col})\tend_pos: {self.end_row, self.end_col}\n'
@@ -535,7 +1118,10 @@ class Move:
         #     if self.piece_captured != '--' else self.gat_rank_file(self.start_row, self.start_col)
         # msg += 'x' if self.piece_captured != '--' else ''
         # msg += self.gat_rank_file(self.end_row, self.end_col)
-        return self.gat_rank_file(self.start_row, self.start_col) + self.gat_rank_file(self.end_row, self.end_col)
+        notation = self.gat_rank_file(self.start_row, self.start_col) + self.gat_rank_file(self.end_row, self.end_col)
+        if self.is_pawn_promotion:
+            notation += self.promotion_piece.lower()
+        return notation
     
     def gat_rank_file(self, row, col):
         return self.cols_to_files[col] + self.row_to_ranks[row]
@@ -0,0 +1,115 @@
+"""
+Runs move generation and search in a separate process, so the GUI keeps drawing and reading input while
+the engine works. Jobs go in through one queue and results come back through another, the GUI polls it
+every frame. Every job has an id: cancelling a job stops its search and its result is never handed out.
+"""
+
+import itertools
+import multiprocessing
+import queue
+
+import chess_engine
+import move_cache
+import search
+
+
+def _replay(game_state_class, fen, move_ids):
+    """
+    Set up the game from its start position and moves, so repetitions are known to the worker too.
+    The moves were played on the GUI, they are legal already and are made without generating any.
+    """
+    gs = game_state_class.from_fen(fen)
+    for move_id in move_ids:
+        gs.make_move(chess_engine.Move.from_id(move_id, gs.board))
+    return gs
+
+
+def _run_worker(requests, results, current_job, game_state_class, tt_size_mb, move_cache_mb):
+    searcher = search.Search(tt_size_mb)
+    # Every job replays a new game state, the cache is what remembers the positions between jobs.
+    cache = move_cache.MoveCache(move_cache_mb) if move_cache_mb else None
+    while True:
+        job = requests.get()
+        if job is None:
+            return
+        job_id, kind, fen, move_ids, limits = job
+        if job_id != current_job.value:
+            continue  # cancelled while waiting in the queue
+        gs = _replay(game_state_class, fen, move_ids)
+        gs.move_cache = cache
+        if kind == 'moves':
+            moves = gs.get_valid_moves()
+            results.put((job_id, kind, {
+                'move_ids': [move.move_id for move in moves],
+                'check_mate': gs.check_mate,
+                'stale_mate': gs.stale_mate,
+                'draw': gs.draw,
+            }))
+        elif kind == 'search':
+            # The search looks at the current job at its budget checks, a newer job or a cancel stops it.
+            searcher.should_stop = lambda: current_job.value != job_id
+            result = searcher.search(gs, limits.get('depth', search.MAX_PLY - 1), limits.get('nodes'),
+                                     limits.get('seconds'))
+            searcher.should_stop = None
+            results.put((job_id, kind, {
+                'move_id': result.best_move.move_id if result.best_move is not None else None,
+                'score': result.score,
+                'depth': result.depth,
+            }))
+
+
+class EngineWorker:
+    """
+    The GUI side of the worker process. submit() hands out a job, poll() returns the finished results of the
+    job that was submitted last, cancel() drops it. Call close() when done.
+    With move_cache_mb the worker keeps the legal moves of that many MB of positions, so going back and
+    forth in a game does not generate them again.
+    """
+
+    def __init__(self, game_state_class=chess_engine.GameState, tt_size_mb=16, move_cache_mb=0):
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.current_job = multiprocessing.Value('q', 0, lock=False)
+        self.job_ids = itertools.count(1)
+        self.busy = False
+        self.process = multiprocessing.Process(
+            target=_run_worker,
+            args=(self.requests, self.results, self.current_job, game_state_class, tt_size_mb, move_cache_mb),
+            daemon=True)
+        self.process.start()
+
+    def submit(self, kind, gs, start_fen=chess_engine.START_FEN, **limits):
+        """
+        Start a 'moves' job (legal moves and game result) or a 'search' job (best move, limits are depth,
+        nodes and seconds) for the position of gs. Any job still running is cancelled. Returns the job id.
+        """
+        job_id = next(self.job_ids)
+        self.current_job.value = job_id
+        self.requests.put((job_id, kind, start_fen, [move.move_id for move in gs.move_log], limits))
+        self.busy = True
+        return job_id
+
+    def cancel(self):
+        self.current_job.value = next(self.job_ids)
+        self.busy = False
+
+    def poll(self):
+        """
+        Return the (kind, result) pairs that came in since the last call, never blocks.
+        """
+        finished = []
+        while True:
+            try:
+                job_id, kind, result = self.results.get_nowait()
+            except queue.Empty:
+                return finished
+            if job_id == self.current_job.value:
+                self.busy = False
+                finished.append((kind, result))
+
+    def close(self):
+        self.cancel()
+        self.requests.put(None)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,343 @@
+"""
+Archive of finished games in a compact binary format, with an index from positions to the games that
+reached them. Queries like "which games reached this position" or the move statistics of an opening
+explorer are answered from the index alone, no game is replayed.
+An archive is two files, both memory-mapped when read:
+    <name>.games    a header, then one record per game: flags, result and number of plies (4 bytes),
+                    the start position when it is not the usual one (71 bytes), then 2 bytes per move id
+    <name>.index    a header, then 14-byte entries sorted by Zobrist key: the key (8 bytes), the offset
+                    of the game record (4) and the ply the position was on the board (2)
+Build one from PGN and query it with:
+    python game_archive.py build games.pgn games
+    python game_archive.py query games --fen "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+"""
+
+import argparse
+import array
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import chess_engine
+import pgn_batch
+
+GAMES_MAGIC = b'CHGAMES1'
+INDEX_MAGIC = b'CHINDEX1'
+# The index header also holds the key of the start position, an index made with other Zobrist numbers is refused.
+INDEX_HEADER = struct.Struct('>8sQ')
+GAME_HEADER = struct.Struct('>BBH')
+START_POSITION = struct.Struct('>67sHH')
+ENTRY = struct.Struct('>QIH')
+KEY = struct.Struct('>Q')
+MOVE_ID = struct.Struct('>H')
+CUSTOM_START = 1
+RESULTS = ('*', '1-0', '0-1', '1/2-1/2')
+RESULT_CODES = {result: code for code, result in enumerate(RESULTS)}
+# Where explore counts a result: after the number of games come white wins, draws and black wins.
+RESULT_COLUMNS = {'1-0': 1, '1/2-1/2': 2, '0-1': 3}
+MAX_OFFSET = (1 << 32) - 1
+MAX_PLIES = (1 << 16) - 1
+# Index entries kept in memory while writing, about 30 MB. Beyond that they go to a sorted temporary file.
+CHUNK_ENTRIES = 1 << 19
+# Entries read at once from every temporary file while they are merged.
+MERGE_ENTRIES = 1 << 12
+
+
+def _start_key():
+    return chess_engine.GameState().zobrist_key
+
+
+class ArchiveWriter:
+    """
+    Write games to a new archive. Index entries are collected in memory up to CHUNK_ENTRIES, then
+    sorted and written to a temporary file next to the archive; close() merges the files into the index.
+    So memory stays bounded however many games are added, the disk needs room for the index twice.
+    Use it as a context manager or call close() when done.
+    """
+
+    def __init__(self, path, max_index_ply=None, game_state_class=chess_engine.GameState):
+        self.path = path
+        self.max_index_ply = max_index_ply
+        self.game_state_class = game_state_class
+        self.file = open(path + '.games', 'wb')
+        self.file.write(GAMES_MAGIC)
+        self.offset = len(GAMES_MAGIC)
+        # key << 48 | offset << 16 | ply, so sorting the numbers sorts the entries
+        self.entries = []
+        self.chunks = []
+        self.games = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_game(self, moves, result='*', start_fen=chess_engine.START_FEN):
+        """
+        Add a game given by its Moves or move ids from start_fen. Returns the offset of its record.
+        Moves are taken to be the legal moves of the game, as they come out of parse_san or a search, and
+        are made as they are. Move ids are checked against the legal moves, a ValueError is raised when one
+        is not legal.
+        """
+        if self.offset > MAX_OFFSET:
+            raise ValueError('The archive is full, game offsets have to fit in 4 bytes')
+        if len(moves) > MAX_PLIES:
+            raise ValueError(f'A game can not have more than {MAX_PLIES} plies')
+        gs = self.game_state_class.from_fen(start_fen)
+        offset = self.offset
+        record = bytearray(GAME_HEADER.pack(0, RESULT_CODES[result], len(moves)))
+        if start_fen != chess_engine.START_FEN:
+            if gs.halfmove_clock > 0xffff or gs.first_fullmove_number > 0xffff:
+                raise ValueError(f'The move counters of a start position have to fit in 2 bytes: {start_fen}')
+            record[0] = CUSTOM_START
+            record += START_POSITION.pack(gs.to_bytes(), gs.halfmove_clock, gs.first_fullmove_number)
+        move_ids = array.array('H')
+        entries = []
+        seen = set()
+        for ply in range(len(moves) + 1):
+            # A position that comes back later in the same game is only indexed the first time.
+            if (self.max_index_ply is None or ply <= self.max_index_ply) and gs.zobrist_key not in seen:
+                seen.add(gs.zobrist_key)
+                entries.append(gs.zobrist_key << 48 | offset << 16 | ply)
+            if ply == len(moves):
+                break
+            if isinstance(moves[ply], chess_engine.Move):
+                move_id = moves[ply].move_id
+                gs.make_move(moves[ply])
+            else:
+                move_id = moves[ply]
+                for move in gs.legal_moves():
+                    if move.move_id == move_id:
+                        gs.make_move(move)
+                        break
+                else:
+                    move = chess_engine.Move.from_id(move_id, gs.board)
+                    raise ValueError(f'Illegal move {move.get_chess_notation()} in {gs.to_fen()}')
+            move_ids.append(move_id)
+        if sys.byteorder != 'big':
+            move_ids.byteswap()
+        record += move_ids.tobytes()
+        # Nothing of a game with an illegal move gets into the archive.
+        self.file.write(record)
+        self.entries.extend(entries)
+        if len(self.entries) >= CHUNK_ENTRIES:
+            self.write_chunk()
+        self.offset += len(record)
+        self.games += 1
+        return offset
+
+    def write_chunk(self):
+        self.entries.sort()
+        chunk = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+        chunk.write(b''.join(ENTRY.pack(entry >> 48, entry >> 16 & 0xffffffff, entry & 0xffff)
+                             for entry in self.entries))
+        chunk.seek(0)
+        self.chunks.append(chunk)
+        self.entries = []
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.entries or not self.chunks:
+            self.write_chunk()
+        try:
+            with open(self.path + '.index', 'wb') as index:
+                index.write(INDEX_HEADER.pack(INDEX_MAGIC, _start_key()))
+                # The entries unpack to (key, offset, ply), which sort like the numbers they were made from.
+                for entry in heapq.merge(*(_read_chunk(chunk) for chunk in self.chunks)):
+                    index.write(ENTRY.pack(*entry))
+        finally:
+            for chunk in self.chunks:
+                chunk.close()
+            self.chunks = []
+
+
+def _read_chunk(chunk):
+    while True:
+        data = chunk.read(ENTRY.size * MERGE_ENTRIES)
+        if not data:
+            return
+        yield from ENTRY.iter_unpack(data)
+
+
+class GameArchive:
+    """
+    An archive opened read-only. Use it as a context manager or call close() when done.
+    """
+
+    def __init__(self, path):
+        self.files = []
+        self.games = self._map(path + '.games')
+        self.index = self._map(path + '.index')
+        if self.games[:len(GAMES_MAGIC)] != GAMES_MAGIC:
+            self.close()
+            raise ValueError(f'{path}.games is not a game archive')
+        if len(self.index) < INDEX_HEADER.size or INDEX_HEADER.unpack_from(self.index) != (INDEX_MAGIC, _start_key()):
+            self.close()
+            raise ValueError(f'{path}.index is not an index made with the Zobrist keys of this engine')
+        self.size = (len(self.index) - INDEX_HEADER.size) // ENTRY.size
+
+    def _map(self, path):
+        file = open(path, 'rb')
+        self.files.append(file)
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''  # an empty file can not be mapped
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for data in (getattr(self, 'games', None), getattr(self, 'index', None)):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for file in self.files:
+            file.close()
+
+    def first_index(self, key):
+        """
+        Index of the first entry with the key, or of where it would be.
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.index, INDEX_HEADER.size + middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def entries(self, key):
+        """
+        Yield (game offset, ply) for every game that had the position with the Zobrist key on the board.
+        """
+        index = self.first_index(key)
+        while index < self.size:
+            entry_key, offset, ply = ENTRY.unpack_from(self.index, INDEX_HEADER.size + index * ENTRY.size)
+            if entry_key != key:
+                return
+            yield offset, ply
+            index += 1
+
+    def find_games(self, gs):
+        """
+        Offsets of the games that reached the position of gs, in the order they were added.
+        """
+        return sorted(offset for offset, ply in self.entries(gs.zobrist_key))
+
+    def game_header(self, offset):
+        """
+        (result, number of plies, offset of the first move id) of the game record at offset.
+        """
+        flags, result, plies = GAME_HEADER.unpack_from(self.games, offset)
+        moves_offset = offset + GAME_HEADER.size + (START_POSITION.size if flags & CUSTOM_START else 0)
+        return RESULTS[result], plies, moves_offset
+
+    def read_game(self, offset):
+        """
+        (start FEN, result, move ids) of the game record at offset.
+        """
+        flags, result, plies = GAME_HEADER.unpack_from(self.games, offset)
+        start_fen = chess_engine.START_FEN
+        moves_offset = offset + GAME_HEADER.size
+        if flags & CUSTOM_START:
+            position, halfmove_clock, fullmove_number = START_POSITION.unpack_from(self.games, moves_offset)
+            gs = chess_engine.GameState()
+            gs.set_bytes(position, halfmove_clock, fullmove_number)
+            start_fen = gs.to_fen()
+            moves_offset += START_POSITION.size
+        move_ids = array.array('H', self.games[moves_offset:moves_offset + 2 * plies])
+        if sys.byteorder != 'big':
+            move_ids.byteswap()
+        return start_fen, RESULTS[result], move_ids.tolist()
+
+    def explore(self, gs):
+        """
+        Opening explorer statistics for the position of gs: a list of (Move, games, white wins, draws,
+        black wins) for every move played from it, most played first. Only the index entries and one
+        move id per game are read.
+        """
+        stats = {}
+        for offset, ply in self.entries(gs.zobrist_key):
+            result, plies, moves_offset = self.game_header(offset)
+            if ply == plies:
+                continue  # the game ended in this position
+            move_id = MOVE_ID.unpack_from(self.games, moves_offset + 2 * ply)[0]
+            counts = stats.setdefault(move_id, [0, 0, 0, 0])
+            counts[0] += 1
+            if result in RESULT_COLUMNS:
+                counts[RESULT_COLUMNS[result]] += 1
+        found = [(chess_engine.Move.from_id(move_id, gs.board), *counts) for move_id, counts in stats.items()]
+        found.sort(key=lambda entry: -entry[1])
+        return found
+
+
+def build(pgn_path, path, max_index_ply=None):
+    """
+    Archive every game of a PGN file, games with an illegal move are left out. Returns (added, skipped).
+    """
+    added = skipped = 0
+    with open(pgn_path, encoding='utf-8', errors='replace') as file, ArchiveWriter(path, max_index_ply) as writer:
+        for tags, movetext in pgn_batch.read_games(file):
+            start_fen = tags.get('FEN') or chess_engine.START_FEN
+            try:
+                gs = chess_engine.GameState.from_fen(start_fen)
+                moves = []
+                for san in pgn_batch.san_moves(movetext):
+                    move = gs.parse_san(san)
+                    gs.make_move(move)
+                    moves.append(move)
+                # The moves are legal already, add_game makes them without generating the legal moves again.
+                writer.add_game(moves, tags.get('Result') if tags.get('Result') in RESULT_CODES else '*', start_fen)
+                added += 1
+            except ValueError:
+                skipped += 1
+    return added, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query binary game archives.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='archive the games of a PGN file')
+    build_parser.add_argument('pgn')
+    build_parser.add_argument('archive', help='path of the archive, without .games or .index')
+    build_parser.add_argument('--max-index-ply', type=int, default=None,
+                              help='only index positions up to this ply, enough for an opening explorer')
+    query_parser = commands.add_parser('query', help='games and move statistics of a position')
+    query_parser.add_argument('archive')
+    query_parser.add_argument('--fen', default=chess_engine.START_FEN)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        added, skipped = build(args.pgn, args.archive, args.max_index_ply)
+        print(f'{added} games archived ({skipped} skipped) in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+        return 0
+    try:
+        gs = chess_engine.GameState.from_fen(args.fen)
+    except ValueError as error:
+        parser.error(str(error))
+    with GameArchive(args.archive) as archive:
+        start = time.perf_counter()
+        games = archive.find_games(gs)
+        found = archive.explore(gs)
+        milliseconds = (time.perf_counter() - start) * 1000
+        print(f'{len(games)} games reached the position ({milliseconds:.2f}ms)')
+        for move, total, white, draws, black in found:
+            print(f'{move.get_chess_notation():6} {total:8} games  {100 * white / total:5.1f}% white  '
+                  f'{100 * draws / total:5.1f}% draws  {100 * black / total:5.1f}% black')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""
+Opt-in counters and timers for the hot paths of GameState. A Profiler is attached to single game states:
+it replaces their methods with counting and timing wrappers on the instance only, so game states it is
+not attached to, and the class itself, run exactly the code they always did at no extra cost.
+    profiler = Profiler()
+    gs = profiler.attach(chess_engine.GameState())
+    ...
+    print(profiler.to_json())
+Timers are inclusive: move generation also contains the legality checks it makes.
+"""
+
+import functools
+import json
+import time
+
+COUNTERS = ('nodes', 'pseudo_legal_moves', 'legal_moves', 'check_for_pins_and_checks', 'square_under_attack')
+TIMERS = ('move_generation', 'make_unmake', 'legality')
+# method name: (timer, counter, how the counter grows: 'call' by one, 'result' by the length of the result)
+TIMED_METHODS = {
+    'make_move': ('make_unmake', 'nodes', 'call'),
+    'undo_move': ('make_unmake', None, None),
+    'legal_moves': ('move_generation', 'legal_moves', 'result'),
+    'check_for_pins_and_checks': ('legality', 'check_for_pins_and_checks', 'call'),
+    'square_under_attack': ('legality', 'square_under_attack', 'call'),
+    'is_square_attacked': ('legality', 'square_under_attack', 'call'),
+    # What the bitboard backend uses for the same work
+    'get_pins': ('legality', 'check_for_pins_and_checks', 'call'),
+    'attackers_to': ('legality', 'square_under_attack', 'call'),
+}
+TIMED_GENERATORS = {
+    'generate_legal_moves': ('move_generation', 'legal_moves'),
+}
+# The mailbox piece generators, they produce moves before the check filter. The bitboard generator
+# makes legal moves directly and never calls them, it reports no pseudo-legal moves.
+PIECE_GENERATORS = ('get_pawn_moves', 'get_rook_moves', 'get_knight_moves', 'get_bishop_moves',
+                    'get_queen_moves', 'get_king_moves', 'get_castle_moves')
+
+
+class Profiler:
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.timers = dict.fromkeys(TIMERS, 0.0)
+        # A phase that is already being timed is not timed again by the calls it makes, and they are not counted.
+        self.active = dict.fromkeys(TIMERS + ('pseudo_legal_moves',), False)
+
+    def reset(self):
+        """
+        Set everything back to zero. The dicts are kept, the wrappers of attached game states hold on to them.
+        """
+        for name in self.counters:
+            self.counters[name] = 0
+        for name in self.timers:
+            self.timers[name] = 0.0
+
+    def snapshot(self):
+        """
+        A copy of the current numbers, safe to keep while counting goes on.
+        """
+        return {
+            'counters': dict(self.counters),
+            'timers': {name: round(seconds, 9) for name, seconds in self.timers.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='chess_engine'):
+        """
+        The numbers in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, value in self.counters.items():
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+        lines.append(f'# TYPE {prefix}_phase_seconds_total counter')
+        for name, seconds in self.timers.items():
+            lines.append(f'{prefix}_phase_seconds_total{{phase="{name}"}} {seconds:.9f}')
+        return '\n'.join(lines) + '\n'
+
+    def attach(self, gs):
+        """
+        Start counting the work done by gs. Returns gs.
+        """
+        for name, (timer, counter, count_by) in TIMED_METHODS.items():
+            if hasattr(gs, name):
+                setattr(gs, name, self.timed(getattr(gs, name), timer, counter, count_by))
+        for name, (timer, counter) in TIMED_GENERATORS.items():
+            setattr(gs, name, self.timed_generator(getattr(gs, name), timer, counter))
+        for name in PIECE_GENERATORS:
+            setattr(gs, name, self.counted_moves(getattr(gs, name)))
+        gs.move_functions = {piece: self.counted_moves(function) for piece, function in gs.move_functions.items()}
+        return gs
+
+    def detach(self, gs):
+        """
+        Put back the plain methods of gs.
+        """
+        for name in list(TIMED_METHODS) + list(TIMED_GENERATORS) + list(PIECE_GENERATORS):
+            gs.__dict__.pop(name, None)
+        gs.move_functions = {piece: getattr(function, '__wrapped__', function)
+                             for piece, function in gs.move_functions.items()}
+        return gs
+
+    def timed(self, function, timer, counter, count_by):
+        active, timers, counters = self.active, self.timers, self.counters
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            if active[timer]:
+                return function(*args)
+            active[timer] = True
+            start = time.perf_counter()
+            try:
+                result = function(*args)
+            finally:
+                timers[timer] += time.perf_counter() - start
+                active[timer] = False
+            if count_by == 'call':
+                counters[counter] += 1
+            elif count_by == 'result':
+                counters[counter] += len(result)
+            return result
+        return wrapper
+
+    def timed_generator(self, function, timer, counter):
+        active, timers, counters = self.active, self.timers, self.counters
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            iterator = function(*args)
+            while True:
+                # Only the time spent producing a move is counted, not what the caller does between two moves.
+                nested = active[timer]
+                if not nested:
+                    active[timer] = True
+                    start = time.perf_counter()
+                try:
+                    move = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    if not nested:
+                        timers[timer] += time.perf_counter() - start
+                        active[timer] = False
+                if not nested:
+                    counters[counter] += 1
+                yield move
+        return wrapper
+
+    def counted_moves(self, function):
+        active, counters = self.active, self.counters
+
+        @functools.wraps(function)
+        def wrapper(row, col, moves):
+            # get_queen_moves calls the rook and bishop generators, the moves are counted once
+            if active['pseudo_legal_moves']:
+                return function(row, col, moves)
+            before = len(moves)
+            active['pseudo_legal_moves'] = True
+            try:
+                function(row, col, moves)
+            finally:
+                active['pseudo_legal_moves'] = False
+            counters['pseudo_legal_moves'] += len(moves) - before
+        return wrapper
@@ -3,34 +3,140 @@ This is our main driver file. It will be responsible for handling user input
 and displaying the current GameState object.
 """
 
-import pygame as pg
+import hashlib
+import os
+import time
+
 import chess_engine
+import bitboard
+import engine_worker
+
+# pygame is imported by import_pygame when the window opens, not here: the engine worker process loads
+# this module again when it is spawned, and it never draws anything.
+pg = None
 
 WIDTH = HEIGHT = 650
 DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
 EXTRA_SPACE_ON_SCREEN = WIDTH - SQ_SIZE * DIMENSION
 FPS = 15
+# Switch to the bitboard move generator, it keeps the same GameState interface.
+USE_BITBOARDS = False
+# Only redraw the squares that changed and sleep until the next event, instead of redrawing
+# the whole window FPS times a second.
+DIRTY_RECT_RENDERING = True
+LIGHT_SQUARE_COLOR = '#fafafa'
+DARK_SQUARE_COLOR = '#868786'
+SELECTED_SQUARE_COLOR = (255, 243, 95)
+MOVE_MARKER_COLOR = '#666564'
+# The engine plays every side that is not human, it gets ENGINE_SECONDS for a move.
+WHITE_IS_HUMAN = True
+BLACK_IS_HUMAN = True
+ENGINE_SECONDS = 2.0
+# Legal moves of positions seen before are kept by the engine worker, undo and redo reuse them.
+MOVE_CACHE_MB = 4
+ANIMATION_SECONDS = 0.25
+# Sent by a timer while a move slides over the board or the engine works, so the loop wakes up to draw and poll.
+# It is pg.USEREVENT + 1, set by import_pygame.
+TICK_EVENT = None
+TICKS_PER_SECOND = 60
 square_piece_size_diff = 0
 IMAGES = {}
+ASSETS_DIR = 'Assets'
+PIECES = ('wR', 'wN', 'wB', 'wQ', 'wK', 'wP', 'bR', 'bN', 'bB', 'bQ', 'bK', 'bP')
+# The pieces, already scaled to the square size, are kept here between launches as one raw RGBA atlas.
+# Decoding and scaling twelve PNGs was most of the startup time.
+SPRITE_CACHE_DIR = '.sprite_cache'
+# Fonts and rendered text surfaces, SysFont looks through the installed fonts on every call.
+FONTS = {}
+TEXT_SURFACES = {}
+
+
+def import_pygame():
+    """
+    Import pygame into the module globals, only the first call does the work.
+    """
+    global pg, TICK_EVENT
+    if pg is None:
+        import pygame
+        pg = pygame
+        TICK_EVENT = pg.USEREVENT + 1
+
+
+def sprite_cache_key(size):
+    """
+    Changes whenever a piece image or the size changes, so an atlas of old images is never used.
+    """
+    digest = hashlib.sha1(str(size).encode())
+    for piece in PIECES:
+        stat = os.stat(os.path.join(ASSETS_DIR, f'{piece}.png'))
+        digest.update(f'{piece}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:16]
+
+
+def build_atlas(size):
+    """
+    Load every piece image, scale it and put them side by side on one surface, in the order of PIECES.
+    """
+    atlas = pg.Surface((size * len(PIECES), size), pg.SRCALPHA)
+    for i, piece in enumerate(PIECES):
+        image = pg.transform.scale(pg.image.load(os.path.join(ASSETS_DIR, f'{piece}.png')), (size, size))
+        atlas.blit(image, (i * size, 0))
+    return atlas
+
+
+def load_atlas(size):
+    """
+    The piece atlas for the size, from the cache when it is there and up to date, otherwise built and cached.
+    """
+    atlas_size = (size * len(PIECES), size)
+    path = os.path.join(SPRITE_CACHE_DIR, f'pieces-{size}-{sprite_cache_key(size)}.rgba')
+    try:
+        with open(path, 'rb') as file:
+            return pg.image.fromstring(file.read(), atlas_size, 'RGBA')
+    except (OSError, ValueError):
+        pass  # not cached yet, or a broken file
+    atlas = build_atlas(size)
+    try:
+        os.makedirs(SPRITE_CACHE_DIR, exist_ok=True)
+        for name in os.listdir(SPRITE_CACHE_DIR):
+            if name.startswith('pieces-'):
+                os.remove(os.path.join(SPRITE_CACHE_DIR, name))
+        # Written under another name first, so another window starting at the same time never reads half a file.
+        with open(path + '.tmp', 'wb') as file:
+            file.write(pg.image.tostring(atlas, 'RGBA'))
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass  # a read-only directory only means no cache, the atlas works all the same
+    return atlas
 
 
 def load_images():
     """
     Initialize a global dictionary of images. This will be called exactly once in the main.
+    Every image is a part of one atlas surface.
     """
-    pieces = ['wR', 'wN', 'wB', 'wQ', 'wK', 'wP', 'bR', 'bN', 'bB', 'bQ', 'bK', 'bP']
-    for piece in pieces:
-        IMAGES[piece] = pg.transform.scale(
-            pg.image.load(f"Assets/{piece}.png"), 
-            (SQ_SIZE-square_piece_size_diff, SQ_SIZE-square_piece_size_diff))
+    size = SQ_SIZE - square_piece_size_diff
+    atlas = load_atlas(size).convert_alpha()
+    for i, piece in enumerate(PIECES):
+        IMAGES[piece] = atlas.subsurface(pg.Rect(i * size, 0, size, size))
     # Note: we can access an image by saying "IMAGES['wP']"
 
 
+def new_game_state():
+    """
+    Create a GameState for the selected backend.
+    """
+    if USE_BITBOARDS:
+        return bitboard.BitboardGameState()
+    return chess_engine.GameState()
+
+
 def main():
     """
     This main driver for our code. This will handle user input and updating the graphics
     """
+    import_pygame()
     pg.init()
     screen = pg.display.set_mode(
         (WIDTH-EXTRA_SPACE_ON_SCREEN, 
@@ -40,8 +146,11 @@ def main():
     pg.display.set_icon(logo)
     pg.display.set_caption('Nazar\'s chess game')
     clock = pg.time.Clock()
-    gs = chess_engine.GameState()
-    valid_moves = gs.get_valid_moves()
+    gs = new_game_state()
+    # Move generation and search run in another process, the window keeps answering while they work.
+    worker = engine_worker.EngineWorker(type(gs), move_cache_mb=MOVE_CACHE_MB)
+    worker.submit('moves', gs)
+    valid_moves = []
     # move_mode is a flag variabla for when a move is made.
     move_made = False
     load_images()
@@ -50,13 +159,24 @@ def main():
     sq_selected = ()
     # The player_clicks is for keeping tracks of clicks (two tuples => [(6, 4), (4, 4)])
     player_clicks = []
+    # Where the pieces on every square can go, worked out once per position instead of every frame.
+    targets = {}
+    view = BoardView(screen) if DIRTY_RECT_RENDERING else None
+    # (move, start time) while the last move slides to its square
+    animation = None
+    ticking = False
 
     while running:
-        for event in pg.event.get():
+        if view is not None:
+            # Nothing changes on screen without an event, so the loop sleeps until there is one.
+            events = [pg.event.wait()] + pg.event.get()
+        else:
+            events = pg.event.get()
+        for event in events:
             if event.type == pg.QUIT:
                 running = False
             # Mouse press handler
-            elif event.type == pg.MOUSEBUTTONDOWN:
+            elif event.type == pg.MOUSEBUTTONDOWN and is_human_turn(gs):
                 location = pg.mouse.get_pos()
                 col = location[0] // SQ_SIZE
                 row = location[1] // SQ_SIZE
@@ -73,45 +193,205 @@ def main():
                             player_clicks[0], 
                             player_clicks[1], 
                             gs.board)
+                        if move.is_pawn_promotion and move in valid_moves:
+                            promotion_piece = input('Promote to Q, R, B or N: ').upper()
+                            if promotion_piece not in chess_engine.Move.promotion_pieces:
+                                promotion_piece = 'Q'
+                            move = chess_engine.Move(
+                                player_clicks[0], 
+                                player_clicks[1], 
+                                gs.board,
+                                promotion_piece=promotion_piece)
                         
                         for i in range(len(valid_moves)):
                             if move == valid_moves[i]:
                                 gs.make_move(valid_moves[i])
                                 print(move.get_chess_notation())
+                                animation = (valid_moves[i], time.perf_counter())
                                 move_made = True
                                 # Resetting user clicks
                                 sq_selected = ()
                                 player_clicks = []
+                                break
                         if not move_made:
                             player_clicks = [sq_selected]
             # Keyboard handler
             elif event.type == pg.KEYDOWN:
                 if event.key == pg.K_c:
+                    # Whatever the engine was doing was about the position that is taken back.
+                    worker.cancel()
+                    if gs.move_log:
+                        print(f'Undo the move: {gs.move_log[-1].get_chess_notation()}')
                     gs.undo_move()
+                    animation = None
                     move_made = True
                 elif event.key == pg.K_r:
-                    gs = chess_engine.GameState()
-                    valid_moves = gs.get_valid_moves()
+                    worker.cancel()
+                    gs = new_game_state()
+                    animation = None
+                    move_made = True
                     print('Game has been reset.')
+            elif event.type == pg.WINDOWEXPOSED and view is not None:
+                # The window was covered or restored, what it shows can not be trusted anymore.
+                view.invalidate()
+
+        for kind, result in worker.poll():
+            if kind == 'moves':
+                valid_moves = [chess_engine.Move.from_id(move_id, gs.board) for move_id in result['move_ids']]
+                targets = movable_targets(valid_moves)
+                gs.check_mate, gs.stale_mate, gs.draw = result['check_mate'], result['stale_mate'], result['draw']
+                if valid_moves and not gs.draw and not is_human_turn(gs):
+                    worker.submit('search', gs, seconds=ENGINE_SECONDS)
+            elif kind == 'search' and result['move_id'] is not None:
+                move = chess_engine.Move.from_id(result['move_id'], gs.board)
+                gs.make_move(move)
+                print(f'{move.get_chess_notation()} (engine, depth {result["depth"]}, score {result["score"]})')
+                animation = (move, time.perf_counter())
+                move_made = True
 
         if move_made:
-            valid_moves = gs.get_valid_moves()
+            # Nothing can be clicked until the worker sends the moves of the new position.
+            valid_moves = []
+            targets = {}
+            gs.check_mate = gs.stale_mate = False
+            gs.draw = None
+            worker.submit('moves', gs)
             move_made = False
 
-        draw_game_state(screen, gs, sq_selected, valid_moves)
+        progress = None
+        if animation is not None:
+            progress = (time.perf_counter() - animation[1]) / ANIMATION_SECONDS
+            if progress >= 1:
+                animation = progress = None
+        needs_ticks = animation is not None or worker.busy
+        if needs_ticks != ticking:
+            pg.time.set_timer(TICK_EVENT, 1000 // TICKS_PER_SECOND if needs_ticks else 0)
+            ticking = needs_ticks
+
+        message = game_over_message(gs)
+        game_over = message is not None
+        if view is not None:
+            view.render(gs.board, sq_selected, targets.get(sq_selected, ()), message,
+                        (animation[0], progress) if animation is not None else None)
+        else:
+            draw_game_state(screen, gs, sq_selected, valid_moves)
+            if animation is not None:
+                animate_move(animation[0], screen, progress)
+            if game_over:
+                draw_text(screen, message)
+            clock.tick(FPS)
+            pg.display.flip()
+    worker.close()
+
+
+def is_human_turn(gs):
+    return WHITE_IS_HUMAN if gs.white_to_move else BLACK_IS_HUMAN
+
+
+def game_over_message(gs):
+    """
+    The text shown over the board when the game has ended, or None while it goes on.
+    """
+    if gs.check_mate:
+        return 'Black win by checkmate' if gs.white_to_move else 'White win by checkmate'
+    if gs.stale_mate:
+        return 'Stalemate'
+    if gs.draw:
+        return f'Draw by {gs.draw}'
+    return None
+
+
+def movable_targets(moves):
+    """
+    Map every square with a piece that can move to the set of squares it can go to.
+    """
+    targets = {}
+    for move in moves:
+        targets.setdefault((move.start_row, move.start_col), set()).add((move.end_row, move.end_col))
+    return targets
+
+
+class BoardView:
+    """
+    Draws the game into the window square by square. It remembers what every square shows, so a frame
+    only redraws the squares that changed and only their rectangles are sent to the display.
+    """
+
+    def __init__(self, screen):
+        self.screen = screen
+        # The empty board is drawn once, a square is cleared by copying it back from here.
+        self.background = pg.Surface((SQ_SIZE * DIMENSION, SQ_SIZE * DIMENSION))
+        colors = [pg.Color(LIGHT_SQUARE_COLOR), pg.Color(DARK_SQUARE_COLOR)]
+        for row in range(DIMENSION):
+            for column in range(DIMENSION):
+                self.background.fill(colors[(row+column) % 2], square_rect(row, column))
+        self.message = None
+        self.sprite_rect = None
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget what is on the screen, the next render draws everything.
+        """
+        # (piece, selected, move marker) drawn on every square, None when unknown
+        self.shown = [[None] * DIMENSION for _ in range(DIMENSION)]
+
+    def render(self, board, sq_selected, targets, message, animation=None):
+        """
+        Bring the window up to date. targets are the squares the selected piece can move to.
+        animation is (move, progress from 0 to 1) while a move that is already made slides to its square.
+        """
+        if message != self.message:
+            # The text covers several squares, the simplest way to take it away is to draw everything again.
+            if self.message is not None:
+                self.invalidate()
+            self.message = message
+            message_changed = True
+        else:
+            message_changed = False
+        dirty = []
+        if self.sprite_rect is not None:
+            # Wipe the moving piece of the last frame by drawing the squares under it again.
+            for row in range(max(0, self.sprite_rect.top // SQ_SIZE),
+                             min(DIMENSION, (self.sprite_rect.bottom - 1) // SQ_SIZE + 1)):
+                for column in range(max(0, self.sprite_rect.left // SQ_SIZE),
+                                    min(DIMENSION, (self.sprite_rect.right - 1) // SQ_SIZE + 1)):
+                    self.shown[row][column] = None
+            dirty.append(self.sprite_rect)
+            self.sprite_rect = None
+        for row in range(DIMENSION):
+            for column in range(DIMENSION):
+                piece = board[row][column]
+                if animation is not None:
+                    piece = piece_before_move(animation[0], row, column, piece)
+                state = (piece, (row, column) == sq_selected, (row, column) in targets)
+                if state != self.shown[row][column]:
+                    self.shown[row][column] = state
+                    dirty.append(self.draw_square(row, column, *state))
+        if animation is not None:
+            self.sprite_rect = draw_moving_piece(self.screen, *animation)
+            dirty.append(self.sprite_rect)
+        if message is not None and (dirty or message_changed):
+            dirty.append(draw_text(self.screen, message))
+        if dirty:
+            pg.display.update(dirty)
+
+    def draw_square(self, row, column, piece, selected, marked):
+        rect = square_rect(row, column)
+        if selected:
+            self.screen.fill(pg.Color(SELECTED_SQUARE_COLOR), rect)
+        else:
+            self.screen.blit(self.background, rect, rect)
+        if marked:
+            pg.draw.circle(self.screen, pg.Color(MOVE_MARKER_COLOR), rect.center, 10, 10)
+        if piece != '--':
+            half_diff = square_piece_size_diff/2
+            self.screen.blit(IMAGES[piece], rect.move(half_diff, half_diff))
+        return rect
 
-        if gs.check_mate:
-            game_over = True
-            if gs.white_to_move:
-                draw_text(screen, 'Black win by checkmate')
-            else:
-                draw_text(screen, 'White win by checkmate')
-        elif gs.stale_mate:
-            game_over = True
-            draw_text(screen, 'Stalemate')
 
-        clock.tick(FPS)
-        pg.display.flip()
+def square_rect(row, column):
+    return pg.Rect(column*SQ_SIZE, row*SQ_SIZE, SQ_SIZE, SQ_SIZE)
 
 
 def draw_game_state(screen, gs, sq_selected, moves):
@@ -176,20 +456,73 @@ def draw_pieces(screen, board):
                     )
 
 
+def get_font(name, size, bold=False, italic=False):
+    key = (name, size, bold, italic)
+    if key not in FONTS:
+        FONTS[key] = pg.font.SysFont(name, size, bold, italic)
+    return FONTS[key]
+
+
 def draw_text(screen, text):
-    font = pg.font.SysFont('Broadway', 34, True, False)
-    text_object = font.render(text, 0, pg.Color('#E5D549'))
+    """
+    Draw the text with its shadow in the middle of the screen and return the rectangle it covers.
+    """
+    if text not in TEXT_SURFACES:
+        font = get_font('Broadway', 34, True, False)
+        TEXT_SURFACES[text] = (font.render(text, 0, pg.Color('#E5D549')), font.render(text, 0, pg.Color('#03256C')))
+    text_object, shadow_object = TEXT_SURFACES[text]
     text_location = pg.Rect(
         0, 0, WIDTH, HEIGHT).move(
             WIDTH/2 - text_object.get_width()/2, 
             HEIGHT/2 - text_object.get_height()/2)
     screen.blit(text_object, text_location)
-    text_object = font.render(text, 0, pg.Color('#03256C'))
-    screen.blit(text_object, text_location.move(4, 4))
+    screen.blit(shadow_object, text_location.move(4, 4))
+    text_rect = text_object.get_rect(topleft=text_location.topleft)
+    return text_rect.union(text_rect.move(4, 4)).clip(screen.get_rect())
+
+
+def piece_before_move(move, row, column, piece):
+    """
+    What stood on the square before the move, for the squares the move took a piece from.
+    The moving piece itself is drawn on top by draw_moving_piece.
+    """
+    if move.is_en_passant_move:
+        if (row, column) == (move.start_row, move.end_col):
+            return move.piece_captured
+        if (row, column) == (move.end_row, move.end_col):
+            return '--'
+    elif (row, column) == (move.end_row, move.end_col):
+        return move.piece_captured
+    return piece
+
 
+def draw_moving_piece(screen, move, progress):
+    """
+    Draw the moved piece the given part (0 to 1) of the way between its squares, return the rectangle it covers.
+    """
+    row = move.start_row + (move.end_row - move.start_row) * progress
+    column = move.start_col + (move.end_col - move.start_col) * progress
+    half_diff = square_piece_size_diff/2
+    rect = pg.Rect(column*SQ_SIZE+half_diff, row*SQ_SIZE+half_diff, SQ_SIZE, SQ_SIZE)
+    screen.blit(IMAGES[move.piece_moved], rect)
+    return rect
 
-def animate_move(move, screen, board):
-    pass
+
+def animate_move(move, screen, progress):
+    """
+    Draw one frame of the move sliding to its square, over a board that already shows the move made.
+    """
+    colors = [pg.Color(LIGHT_SQUARE_COLOR), pg.Color(DARK_SQUARE_COLOR)]
+    squares = [(move.end_row, move.end_col)]
+    if move.is_en_passant_move:
+        squares.append((move.start_row, move.end_col))
+    for row, column in squares:
+        screen.fill(colors[(row+column) % 2], square_rect(row, column))
+        piece = piece_before_move(move, row, column, '--')
+        if piece != '--':
+            half_diff = square_piece_size_diff/2
+            screen.blit(IMAGES[piece], square_rect(row, column).move(half_diff, half_diff))
+    draw_moving_piece(screen, move, progress)
 
 
 if __name__ == "__main__":
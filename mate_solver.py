@@ -0,0 +1,302 @@
+"""
+Proves or disproves forced mates with proof-number search, for checking sets of tactical puzzles.
+Alpha-beta has to search every line to the full depth; proof-number search grows the tree only where
+a proof or a refutation looks nearest, which finds long forcing mates with far fewer nodes.
+Every node has a proof number (how many leaves still have to be shown to be mates) and a disproof
+number (how many to be escapes). The leaf that is part of the smallest proof and disproof is expanded
+next, and every new position is looked at with get_valid_moves, whose check_mate flag ends the line.
+Run it with:
+    python mate_solver.py puzzles.epd --workers 8 --output results.jsonl
+    python mate_solver.py --fen "kbK5/pp6/1P6/8/8/8/8/R7 w - - 0 1" --max-moves 2
+Puzzles are one FEN or EPD per line. The EPD operations id (name), dm (mate in that many moves) and
+bm (the expected first move, in SAN) are used when they are there.
+"""
+
+import argparse
+import array
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import chess_engine
+import perft
+
+INFINITY = 10 ** 9
+# Mates longer than this are not looked for when a puzzle does not say how long its mate is.
+DEFAULT_MAX_MOVES = 5
+DEFAULT_NODES = 1000000
+DEFAULT_MEMORY_MB = 256
+# Rough size of one tree node in CPython: the node with its slots, its Move, its place in the children list
+# and, while it is a leaf, the move ids of its position.
+NODE_BYTES = 380
+
+_worker_game_state_class = None
+
+
+class Node:
+    """
+    A position of the proof tree. Attacker nodes (the side that mates is to move) are proven when any child
+    is, defender nodes when all children are. children is None until the node is expanded, until then
+    move_ids holds the legal moves found when the node was created, so they are not generated twice.
+    """
+    __slots__ = ('move', 'attacker', 'proof', 'disproof', 'children', 'move_ids')
+
+    def __init__(self, move, attacker):
+        self.move = move
+        self.attacker = attacker
+        self.proof = 1
+        self.disproof = 1
+        self.children = None
+        self.move_ids = None
+
+
+class MateSolver:
+    """
+    Proof-number search for a mate by the side to move within max_moves moves. The search stops when it
+    runs out of nodes created, of tree nodes kept in memory, or of time.
+    """
+
+    def __init__(self, max_moves=DEFAULT_MAX_MOVES, max_nodes=DEFAULT_NODES, memory_mb=DEFAULT_MEMORY_MB,
+                 max_time=None):
+        self.max_plies = 2 * max_moves - 1
+        self.max_nodes = max_nodes
+        self.max_tree_nodes = memory_mb * 1024 * 1024 // NODE_BYTES
+        self.max_time = max_time
+        self.nodes = 0
+        self.tree_nodes = 0
+
+    def solve(self, gs):
+        """
+        Returns ('mate', line of Moves) when the mate is proven, ('no mate', []) when it is disproven and
+        ('unknown', []) when a budget ran out first. gs is left as it was given.
+        """
+        deadline = time.perf_counter() + self.max_time if self.max_time is not None else None
+        self.nodes = self.tree_nodes = 1
+        root = Node(None, True)
+        self.set_numbers(root, gs, 0)
+        while root.proof and root.disproof:
+            if self.nodes >= self.max_nodes or self.tree_nodes >= self.max_tree_nodes \
+                    or (deadline is not None and time.perf_counter() >= deadline):
+                return 'unknown', []
+            # Go down to the most proving leaf, the path is kept to update the numbers on the way back.
+            path = [root]
+            node = root
+            while node.children is not None:
+                if node.attacker:
+                    node = min(node.children, key=lambda child: child.proof)
+                else:
+                    node = min(node.children, key=lambda child: child.disproof)
+                gs.make_move(node.move)
+                path.append(node)
+            self.expand(node, gs, len(path) - 1)
+            for node in reversed(path):
+                self.update(node)
+                if node.move is not None:
+                    gs.undo_move()
+        if root.proof == 0:
+            return 'mate', self.mate_line(root, gs)[1]
+        return 'no mate', []
+
+    def set_numbers(self, node, gs, ply):
+        """
+        Give a new node its numbers from its position: solved when the game is over there or the attacker
+        has no moves left, else estimated from the number of moves, as every one of them needs an answer.
+        """
+        moves = gs.get_valid_moves()
+        if gs.check_mate:
+            # Mated is good for the attacker only when it is the defender that has to move.
+            node.proof, node.disproof = (INFINITY, 0) if node.attacker else (0, INFINITY)
+        elif gs.stale_mate or gs.draw or ply >= self.max_plies:
+            node.proof, node.disproof = INFINITY, 0
+        else:
+            node.move_ids = array.array('H', [move.move_id for move in moves])
+            if node.attacker:
+                node.proof, node.disproof = 1, len(moves)
+            else:
+                node.proof, node.disproof = len(moves), 1
+
+    def expand(self, node, gs, ply):
+        children = []
+        for move_id in node.move_ids:
+            move = chess_engine.Move.from_id(move_id, gs.board)
+            child = Node(move, not node.attacker)
+            gs.make_move(move)
+            self.set_numbers(child, gs, ply + 1)
+            gs.undo_move()
+            children.append(child)
+        node.children = children
+        node.move_ids = None
+        self.nodes += len(children)
+        self.tree_nodes += len(children)
+
+    def update(self, node):
+        if node.children is None:
+            return
+        proofs = [child.proof for child in node.children]
+        disproofs = [child.disproof for child in node.children]
+        if node.attacker:
+            node.proof, node.disproof = min(proofs), min(sum(disproofs), INFINITY)
+        else:
+            node.proof, node.disproof = min(sum(proofs), INFINITY), min(disproofs)
+        # Solved subtrees are cut back to what the solution line needs, which keeps the tree small.
+        if node.disproof == 0:
+            self.release(node, node.children)
+            node.children = []
+        elif node.proof == 0 and node.attacker:
+            proving = next(child for child in node.children if child.proof == 0)
+            self.release(node, [child for child in node.children if child is not proving])
+            node.children = [proving]
+
+    def release(self, node, children):
+        stack = list(children)
+        while stack:
+            child = stack.pop()
+            self.tree_nodes -= 1
+            if child.children:
+                stack.extend(child.children)
+
+    def mate_line(self, node, gs):
+        """
+        (plies, Moves) of the mate below a proven node: the quickest mate of the attacker against the
+        longest defence, both within the proof tree.
+        """
+        if not node.children:
+            return 0, []
+        best = None
+        for child in node.children:
+            if child.proof != 0:
+                continue
+            gs.make_move(child.move)
+            plies, line = self.mate_line(child, gs)
+            gs.undo_move()
+            if best is None or (plies < best[0] if node.attacker else plies > best[0]):
+                best = (plies, [child.move] + line)
+        return best[0] + 1, best[1]
+
+
+def read_puzzles(path):
+    """
+    The puzzles of a file with one FEN or EPD per line, as dicts with name, fen, dm and bm.
+    Raises ValueError for a bad position.
+    """
+    puzzles = []
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 4)
+            fen = ' '.join(fields[:4])
+            operations = {}
+            rest = fields[4] if len(fields) > 4 else ''
+            counters = rest.split()[:2]
+            # A FEN ends with the two move counters, an EPD has operations there instead.
+            if len(counters) == 2 and counters[0].isdigit() and counters[1].isdigit():
+                fen += f' {counters[0]} {counters[1]}'
+            else:
+                fen += ' 0 1'
+                for operation in rest.split(';'):
+                    opcode, _, operand = operation.strip().partition(' ')
+                    if opcode:
+                        operations[opcode] = operand.strip().strip('"')
+            try:
+                chess_engine.GameState.from_fen(fen)
+            except ValueError as error:
+                raise ValueError(f'{path}:{line_number}: {error}') from None
+            puzzles.append({
+                'name': operations.get('id', f'{os.path.basename(path)}:{line_number}'),
+                'fen': fen,
+                'dm': int(operations['dm']) if operations.get('dm', '').isdigit() else None,
+                'bm': operations.get('bm', '').split() or None,
+            })
+    return puzzles
+
+
+def _init_worker(game_state_class):
+    global _worker_game_state_class
+    _worker_game_state_class = game_state_class
+
+
+def solve_puzzle(task):
+    """
+    Solve one puzzle and return its result dict. Runs in a worker process.
+    """
+    index, puzzle, max_moves, max_nodes, memory_mb, max_time = task
+    gs = _worker_game_state_class.from_fen(puzzle['fen'])
+    solver = MateSolver(puzzle['dm'] or max_moves, max_nodes, memory_mb, max_time)
+    start = time.perf_counter()
+    result, line = solver.solve(gs)
+    seconds = time.perf_counter() - start
+    san_line = []
+    for move in line:
+        san_line.append(gs.move_to_san(move))
+        gs.make_move(move)
+    report = {'puzzle': index, 'name': puzzle['name'], 'fen': puzzle['fen'], 'result': result,
+              'mate_in': (len(line) + 1) // 2 if line else None, 'line': san_line,
+              'nodes': solver.nodes, 'seconds': round(seconds, 4)}
+    if puzzle['bm']:
+        # The expected move may be written with or without its check sign.
+        report['correct'] = bool(san_line) and san_line[0].rstrip('+#') in [move.rstrip('+#') for move in puzzle['bm']]
+    return report
+
+
+def solve_all(puzzles, workers=None, max_moves=DEFAULT_MAX_MOVES, max_nodes=DEFAULT_NODES,
+              memory_mb=DEFAULT_MEMORY_MB, max_time=None, game_state_class=chess_engine.GameState):
+    """
+    Yield the result dicts of the puzzles, in their order.
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = ((index, puzzle, max_moves, max_nodes, memory_mb, max_time) for index, puzzle in enumerate(puzzles))
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(game_state_class,)) as pool:
+        yield from pool.imap(solve_puzzle, tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prove or disprove forced mates with proof-number search.')
+    parser.add_argument('puzzles', nargs='?', help='file with one FEN or EPD per line')
+    parser.add_argument('--fen', help='solve this one position instead')
+    parser.add_argument('--output', help='JSON lines file for the results, stdout by default')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all cores by default')
+    parser.add_argument('--max-moves', type=int, default=DEFAULT_MAX_MOVES,
+                        help='longest mate looked for when the puzzle has no dm')
+    parser.add_argument('--nodes', type=int, default=DEFAULT_NODES, help='most nodes per puzzle')
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_MEMORY_MB, help='most memory per puzzle tree')
+    parser.add_argument('--seconds', type=float, default=None, help='most time per puzzle')
+    parser.add_argument('--backend', choices=sorted(perft.BACKENDS), default='mailbox')
+    args = parser.parse_args()
+
+    try:
+        if args.fen:
+            chess_engine.GameState.from_fen(args.fen)
+            puzzles = [{'name': 'fen', 'fen': args.fen, 'dm': None, 'bm': None}]
+        elif args.puzzles:
+            puzzles = read_puzzles(args.puzzles)
+        else:
+            parser.error('give a puzzle file or --fen')
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    start = time.perf_counter()
+    counts = {'mate': 0, 'no mate': 0, 'unknown': 0}
+    wrong = 0
+    try:
+        for result in solve_all(puzzles, args.workers, args.max_moves, args.nodes, args.memory_mb, args.seconds,
+                                perft.BACKENDS[args.backend]):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            counts[result['result']] += 1
+            wrong += result.get('correct') is False
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    seconds = time.perf_counter() - start
+    print(f'{len(puzzles)} puzzles: {counts["mate"]} mates, {counts["no mate"]} without mate, '
+          f'{counts["unknown"]} unknown, {wrong} with another first move than bm, {seconds:.2f}s', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
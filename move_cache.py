@@ -0,0 +1,73 @@
+"""
+A bounded cache of legal move lists, in front of GameState.get_valid_moves. The GUI, the engine worker and
+long running servers ask for the moves of the same positions again and again: after an undo, when a client
+reconnects, or when two move orders reach the same position. The cache is opt-in and can be shared:
+    cache = MoveCache(size_mb=4)
+    gs.move_cache = cache
+Positions are keyed by GameState.to_bytes, the whole board with side to move, castling rights and
+en-passant square, so unlike a Zobrist key two different positions can never share an entry.
+Only what follows from the position is cached. The draw flag depends on the game history and is worked
+out fresh on every call.
+"""
+
+import collections
+
+# Rough sizes in CPython: the key, the entry tuples and the dict slot, and then every Move with its __slots__.
+ENTRY_BYTES = 300
+MOVE_BYTES = 128
+
+
+class MoveCache:
+    """
+    Least recently used positions are dropped once the estimated size goes over size_mb.
+    """
+
+    def __init__(self, size_mb=4):
+        self.max_bytes = int(size_mb * 1024 * 1024)
+        # key: (moves as a tuple, in_check)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def legal_moves(self, gs):
+        """
+        The legal moves of gs as a new list, and gs.in_check set like the move generator sets it.
+        The cached tuple is never handed out, so callers can change the list they get.
+        """
+        key = gs.to_bytes()
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            gs.in_check = entry[1]
+            return list(entry[0])
+        self.misses += 1
+        moves = gs.legal_moves()
+        self.entries[key] = (tuple(moves), gs.in_check)
+        self.bytes += ENTRY_BYTES + MOVE_BYTES * len(moves)
+        while self.bytes > self.max_bytes and self.entries:
+            _, (old_moves, _) = self.entries.popitem(last=False)
+            self.bytes -= ENTRY_BYTES + MOVE_BYTES * len(old_moves)
+            self.evictions += 1
+        return moves
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
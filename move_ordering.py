@@ -0,0 +1,245 @@
+"""
+Move ordering for the alpha-beta search. The sooner the best move of a node is searched, the sooner the
+node is cut off, so the order decides most of the size of the tree. Moves are tried in stages:
+    hash move          the best move the transposition table remembers for the position
+    good captures      captures that do not lose material by static exchange evaluation, MVV-LVA order
+    promotions
+    killer moves       quiet moves that caused a cutoff at the same ply in a sibling node
+    quiet moves        ordered by the history table, how often a piece moving to a square caused a cutoff
+    bad captures       captures that lose material in the exchange on the target square
+MoveOrderer also counts the cutoffs, and how many of them came from the first move searched, which is
+the number to look at when changing anything here. Run it with:
+    python move_ordering.py --depth 5
+"""
+
+import argparse
+import sys
+import time
+
+import chess_engine
+
+# Piece values for the static exchange evaluation. The king is worth more than anything it can win.
+SEE_VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 20000}
+KILLER_SLOTS = 2
+# The history table is halved when a value gets this big, so old cutoffs count less than new ones.
+HISTORY_LIMIT = 1 << 20
+STAGES = ('hash', 'good_capture', 'promotion', 'killer', 'quiet', 'bad_capture')
+
+
+def least_valuable_attacker(board, row, col, color, removed):
+    """
+    (value, square) of the cheapest piece of color attacking row, col, or None. Pieces on the removed
+    squares are taken as gone, so sliders behind them attack through.
+    """
+    best = None
+    pawn = color + 'P'
+    pawn_row = row + 1 if color == 'w' else row - 1
+    if 0 <= pawn_row < 8:
+        for pawn_col in (col - 1, col + 1):
+            if 0 <= pawn_col < 8 and board[pawn_row][pawn_col] == pawn and (pawn_row, pawn_col) not in removed:
+                return SEE_VALUES['P'], (pawn_row, pawn_col)
+    for targets, kind in ((chess_engine.KNIGHT_TARGETS, 'N'), (chess_engine.KING_TARGETS, 'K')):
+        for square in targets[row][col]:
+            if board[square[0]][square[1]] == color + kind and square not in removed:
+                if best is None or SEE_VALUES[kind] < best[0]:
+                    best = (SEE_VALUES[kind], square)
+                break
+    for rays, kinds in ((chess_engine.DIAGONAL_RAYS, 'BQ'), (chess_engine.ORTHOGONAL_RAYS, 'RQ')):
+        for ray in rays[row][col]:
+            for square in ray:
+                piece = board[square[0]][square[1]]
+                if piece == '--' or square in removed:
+                    continue
+                if piece[0] == color and piece[1] in kinds and (best is None or SEE_VALUES[piece[1]] < best[0]):
+                    best = (SEE_VALUES[piece[1]], square)
+                break
+    return best
+
+
+def see(board, move):
+    """
+    Static exchange evaluation: the material the side to move wins with move when both sides keep
+    recapturing on the target square with their cheapest piece, and each may stop when it likes.
+    Pins are not looked at. Negative for a capture that loses material.
+    """
+    row, col = move.end_row, move.end_col
+    gains = [SEE_VALUES[move.piece_captured[1]] if move.piece_captured != '--' else 0]
+    on_square = SEE_VALUES[move.promotion_piece if move.is_pawn_promotion else move.piece_moved[1]]
+    if move.is_pawn_promotion:
+        gains[0] += SEE_VALUES[move.promotion_piece] - SEE_VALUES['P']
+    removed = {(move.start_row, move.start_col)}
+    color = 'b' if move.piece_moved[0] == 'w' else 'w'
+    while True:
+        attacker = least_valuable_attacker(board, row, col, color, removed)
+        if attacker is None:
+            break
+        # What this side gets by taking, if the other side then does its best.
+        gains.append(on_square - gains[-1])
+        on_square = attacker[0]
+        removed.add(attacker[1])
+        color = 'b' if color == 'w' else 'w'
+    for depth in range(len(gains) - 1, 0, -1):
+        gains[depth - 1] = -max(-gains[depth - 1], gains[depth])
+    return gains[0]
+
+
+def is_losing_capture(board, move):
+    """
+    True when the capture loses material in the exchange. Taking a piece worth at least as much as the
+    capturing one never does, which saves the full exchange for most captures.
+    """
+    if move.is_en_passant_move or SEE_VALUES[move.piece_moved[1]] <= SEE_VALUES[move.piece_captured[1]]:
+        return False
+    return see(board, move) < 0
+
+
+class MoveOrderer:
+    """
+    The killer moves and the history table of one Search, and the cutoff statistics. The heuristics can be
+    switched off one by one to see what each of them is worth.
+    """
+
+    def __init__(self, killers=True, history=True, exchange=True, max_ply=128):
+        self.use_killers = killers
+        self.use_history = history
+        self.use_exchange = exchange
+        self.max_ply = max_ply
+        self.killers = [[None] * KILLER_SLOTS for _ in range(max_ply + 1)]
+        self.history = {piece: [0] * 64 for piece in chess_engine.PIECE_CODES[1:]}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.stage_cutoffs = dict.fromkeys(STAGES, 0)
+
+    def new_search(self):
+        """
+        Killers are about the plies of the last search, they are dropped. History is kept but counts half.
+        """
+        self.killers = [[None] * KILLER_SLOTS for _ in range(self.max_ply + 1)]
+        for scores in self.history.values():
+            for sq in range(64):
+                scores[sq] >>= 1
+
+    def clear(self):
+        self.killers = [[None] * KILLER_SLOTS for _ in range(self.max_ply + 1)]
+        self.history = {piece: [0] * 64 for piece in chess_engine.PIECE_CODES[1:]}
+
+    def ordered_moves(self, gs, hash_move_id, ply):
+        """
+        Yield (move, stage) for the legal moves of gs, in the order they should be searched.
+        The hash move is checked by generating the moves of its piece only, a cutoff on it costs no full generation.
+        """
+        if hash_move_id is not None:
+            start_sq = ((hash_move_id >> 3) & 7, hash_move_id & 7)
+            for move in gs.generate_legal_moves((start_sq,)):
+                if move.move_id == hash_move_id:
+                    yield move, 'hash'
+                    break
+        good_captures = []
+        bad_captures = []
+        promotions = []
+        quiet_moves = []
+        killer_moves = []
+        killers = self.killers[ply] if self.use_killers and ply <= self.max_ply else ()
+        for move in gs.generate_legal_moves():
+            if move.move_id == hash_move_id:
+                continue
+            if move.piece_captured != '--':
+                if self.use_exchange and is_losing_capture(gs.board, move):
+                    bad_captures.append(move)
+                else:
+                    good_captures.append(move)
+            elif move.is_pawn_promotion:
+                promotions.append(move)
+            elif move.move_id in killers:
+                killer_moves.append(move)
+            else:
+                quiet_moves.append(move)
+        good_captures.sort(key=chess_engine.mvv_lva)
+        for move in good_captures:
+            yield move, 'good_capture'
+        for move in promotions:
+            yield move, 'promotion'
+        # The first killer slot holds the most recent one.
+        killer_moves.sort(key=lambda move: killers.index(move.move_id))
+        for move in killer_moves:
+            yield move, 'killer'
+        if self.use_history:
+            history = self.history
+            quiet_moves.sort(key=lambda move: -history[move.piece_moved][move.end_row * 8 + move.end_col])
+        for move in quiet_moves:
+            yield move, 'quiet'
+        bad_captures.sort(key=chess_engine.mvv_lva)
+        for move in bad_captures:
+            yield move, 'bad_capture'
+
+    def record_cutoff(self, move, stage, moves_searched, depth, ply):
+        """
+        Note that move caused a beta cutoff after moves_searched moves, a quiet move becomes a killer
+        and gains history.
+        """
+        self.cutoffs += 1
+        if moves_searched == 1:
+            self.first_move_cutoffs += 1
+        self.stage_cutoffs[stage] += 1
+        if move.piece_captured != '--' or move.is_pawn_promotion:
+            return
+        if self.use_killers and ply <= self.max_ply:
+            killers = self.killers[ply]
+            if killers[0] != move.move_id:
+                killers[1:] = killers[:-1]
+                killers[0] = move.move_id
+        if self.use_history:
+            scores = self.history[move.piece_moved]
+            sq = move.end_row * 8 + move.end_col
+            scores[sq] += depth * depth
+            if scores[sq] >= HISTORY_LIMIT:
+                for piece_scores in self.history.values():
+                    for i in range(64):
+                        piece_scores[i] >>= 1
+
+    def stats(self):
+        return {
+            'cutoffs': self.cutoffs,
+            'first_move_cutoffs': self.first_move_cutoffs,
+            'first_move_cutoff_rate': self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.0,
+            'stage_cutoffs': dict(self.stage_cutoffs),
+        }
+
+
+def main():
+    # Only the benchmark needs these, search itself imports this module.
+    import perft
+    import search
+
+    parser = argparse.ArgumentParser(description='Compare move ordering heuristics on the perft positions.')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--backend', choices=sorted(perft.BACKENDS), default='mailbox')
+    args = parser.parse_args()
+
+    configurations = (
+        ('hash move and MVV-LVA', dict(killers=False, history=False, exchange=False)),
+        ('+ exchange evaluation', dict(killers=False, history=False, exchange=True)),
+        ('+ killers', dict(killers=True, history=False, exchange=True)),
+        ('+ history', dict(killers=True, history=True, exchange=True)),
+    )
+    for name, options in configurations:
+        nodes = cutoffs = first_move_cutoffs = 0
+        start = time.perf_counter()
+        for _, fen, _ in perft.REFERENCE_POSITIONS:
+            searcher = search.Search(16, MoveOrderer(**options))
+            result = searcher.search(perft.BACKENDS[args.backend].from_fen(fen), args.depth)
+            stats = searcher.ordering.stats()
+            nodes += result.nodes
+            cutoffs += stats['cutoffs']
+            first_move_cutoffs += stats['first_move_cutoffs']
+        seconds = time.perf_counter() - start
+        print(f'{name:24} {nodes:9} nodes  {100 * first_move_cutoffs / max(cutoffs, 1):5.1f}% first move cutoffs  '
+              f'{seconds:6.2f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+Parallel search over a pool of worker processes. Threads would not help, the GIL lets only one of them
+search at a time. The root moves are split between the workers. Every iteration of the iterative deepening
+first searches the best move of the last iteration with the full window, then all the other root moves with
+a null window around the best score so far, which only has to prove that a move is not better. The few moves
+that fail high are searched again with an open window. A better score is published to the workers in shared
+memory as soon as it is found, so a task that starts later searches with the tighter bound. The nodes
+searched are counted in shared memory too, every task may use whatever is left of the node budget.
+Positions travel to the workers as the 67 bytes of GameState.to_bytes with the halfmove clock and the keys of
+the earlier positions, never as pickled GameState objects, so fifty-move and repetition draws are seen.
+Run it with:
+    python parallel_search.py --workers 8 --time 10
+    python parallel_search.py --fen "<fen>" --depth 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+
+import chess_engine
+import perft
+import search
+
+# Every worker process keeps its own Search, so its transposition table survives between tasks.
+_worker_search = None
+_worker_game_state_class = None
+_worker_alpha = None
+_worker_nodes = None
+# The search the worker last took a task of, its tables are aged once when a new one starts.
+_worker_search_id = None
+
+
+def _init_worker(tt_size_mb, game_state_class, alpha, nodes):
+    global _worker_search, _worker_game_state_class, _worker_alpha, _worker_nodes
+    _worker_search = search.Search(tt_size_mb)
+    _worker_game_state_class = game_state_class
+    _worker_alpha = alpha
+    _worker_nodes = nodes
+
+
+def _count_nodes(counted):
+    """
+    Add the nodes the worker searched since the last call to the shared count and return the new total.
+    counted is a one element list with the nodes already added.
+    """
+    with _worker_nodes.get_lock():
+        _worker_nodes.value += _worker_search.nodes - counted[0]
+        total = _worker_nodes.value
+    counted[0] = _worker_search.nodes
+    return total
+
+
+def _search_root_move(task):
+    """
+    Search one root move in a worker, with a null window above alpha or, for a re-search, an open window.
+    The alpha published by the parent is used when it is higher than the one of the task.
+    Returns (move_id, null_window, alpha used, score, pv move ids, nodes), the score is None when the budget
+    ran out before the search finished. A score above the alpha used is exact after an open window search
+    and a lower bound after a null window one.
+    """
+    search_id, position, halfmove_clock, position_counts, move_id, depth, alpha, null_window, max_nodes, \
+        deadline = task
+    global _worker_search_id
+    if search_id != _worker_search_id:
+        _worker_search_id = search_id
+        _worker_search.new_search()
+    gs = _worker_game_state_class()
+    gs.set_bytes(position, halfmove_clock)
+    gs.position_counts = dict(position_counts)
+    for move in gs.legal_moves():
+        if move.move_id == move_id:
+            gs.make_move(move)
+            break
+    alpha = max(alpha, _worker_alpha.value)
+    beta = alpha + 1 if null_window else search.INFINITY
+    max_time = None if deadline is None else max(0.0, deadline - time.time())
+    counted = [0]
+    task_nodes = None
+    if max_nodes is not None:
+        # The task may use all that is left, the shared count stops it when the other workers use it up first.
+        task_nodes = max_nodes - _worker_nodes.value
+        if task_nodes <= 0:
+            return move_id, null_window, alpha, None, [], 0
+        _worker_search.should_stop = lambda: _count_nodes(counted) >= max_nodes
+    try:
+        result = _worker_search.search_depth(gs, depth - 1, ply=1, max_nodes=task_nodes, max_time=max_time,
+                                             alpha=-beta, beta=-alpha)
+    finally:
+        _worker_search.should_stop = None
+        _count_nodes(counted)
+    if result is None:
+        return move_id, null_window, alpha, None, [], _worker_search.nodes
+    score, pv = result
+    return move_id, null_window, alpha, -score, [move.move_id for move in pv], _worker_search.nodes
+
+
+class ParallelSearch:
+    """
+    Owns the worker pool, so it can be reused for all the searches of a game. Use it as a context manager
+    or call close() when done.
+    """
+
+    def __init__(self, workers=None, tt_size_mb=16, game_state_class=chess_engine.GameState):
+        self.workers = workers or os.cpu_count() or 1
+        # The best root score of the running iteration, workers read it when they start a task.
+        self.alpha = multiprocessing.Value('i', -search.INFINITY)
+        # The nodes all workers searched in the running search.
+        self.spent = multiprocessing.Value('q', 0)
+        self.pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                         initargs=(tt_size_mb, game_state_class, self.alpha, self.spent))
+        self.search_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def search(self, gs, max_depth=64, max_nodes=None, max_time=None):
+        """
+        Same contract as search.Search.search: returns the SearchResult of the deepest iteration, which
+        may be one that ran out of budget after its first root move was searched. Then the best of the
+        root moves searched to the end is taken. All workers count their nodes against max_nodes together,
+        each may go over it by the nodes between two budget checks.
+        """
+        start = time.perf_counter()
+        deadline = time.time() + max_time if max_time is not None else None
+        root_moves = gs.legal_moves()
+        if len(root_moves) == 0:
+            score = -search.MATE_SCORE if gs.in_check else 0
+            return search.SearchResult(None, score, [], 0, 0, time.perf_counter() - start)
+
+        self.search_id += 1
+        root = (self.search_id, gs.to_bytes(), gs.halfmove_clock, tuple(gs.position_counts.items()))
+        order = [move.move_id for move in root_moves]
+        result = search.SearchResult(root_moves[0], 0, [root_moves[0]], 0, 0, 0.0)
+        self.nodes = 0
+        self.spent.value = 0
+        for depth in range(1, max_depth + 1):
+            iteration = self.search_iteration(root, order, depth, max_nodes, deadline)
+            if iteration is None:
+                break
+            best_score, pv_ids, finished = iteration
+            # The best move goes first in the next iteration, the others keep their order.
+            order.remove(pv_ids[0])
+            order.insert(0, pv_ids[0])
+            pv = moves_from_ids(gs, pv_ids)
+            result = search.SearchResult(pv[0], best_score, pv, self.nodes, depth, time.perf_counter() - start)
+            if not finished or abs(best_score) >= search.MATE_BOUND:
+                break
+        result.nodes = self.nodes
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def search_iteration(self, root, order, depth, max_nodes, deadline):
+        """
+        Search all root moves to depth, the first one alone with the full window and the others in parallel
+        with null windows. Returns (best score, pv move ids, finished), finished is False when the budget ran
+        out before every root move was searched, or None when it ran out during the first one.
+        """
+        results = queue.Queue()
+        self.alpha.value = -search.INFINITY
+        out_of_budget = False
+
+        def submit(move_id, alpha, null_window):
+            self.pool.apply_async(_search_root_move, ((*root, move_id, depth, alpha, null_window, max_nodes,
+                                                       deadline),), callback=results.put, error_callback=results.put)
+
+        def wait():
+            reply = results.get()
+            if isinstance(reply, BaseException):
+                raise reply
+            self.nodes += reply[-1]
+            return reply
+
+        # The best move of the last iteration, searched alone, gives the bound for all the others.
+        submit(order[0], -search.INFINITY, False)
+        move_id, _, _, best_score, pv_ids, _ = wait()
+        if best_score is None:
+            return None
+        best_pv = [move_id] + pv_ids
+        self.alpha.value = best_score
+        for move_id in order[1:]:
+            submit(move_id, best_score, True)
+        pending = len(order) - 1
+        while pending:
+            move_id, null_window, alpha, score, pv_ids, _ = wait()
+            pending -= 1
+            if score is None:
+                out_of_budget = True
+            elif score <= alpha:
+                continue
+            elif null_window:
+                # The move is better than alpha, only an open window search tells by how much.
+                if not out_of_budget:
+                    submit(move_id, best_score, False)
+                    pending += 1
+            elif score > best_score:
+                best_score, best_pv = score, [move_id] + pv_ids
+                self.alpha.value = best_score
+        return best_score, best_pv, not out_of_budget
+
+
+def moves_from_ids(gs, move_ids):
+    """
+    Turn a line of move ids, as sent back by the workers, into Move objects of the game.
+    """
+    moves = []
+    for move_id in move_ids:
+        for move in gs.legal_moves():
+            if move.move_id == move_id:
+                moves.append(move)
+                gs.make_move(move)
+                break
+        else:
+            break
+    for _ in moves:
+        gs.undo_move()
+    return moves
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search a position with several worker processes.')
+    parser.add_argument('--fen', default=perft.START_FEN)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all cores by default')
+    parser.add_argument('--depth', type=int, default=64)
+    parser.add_argument('--nodes', type=int, default=None)
+    parser.add_argument('--time', type=float, default=None, help='seconds')
+    parser.add_argument('--hash', type=int, default=16, help='transposition table size per worker in MB')
+    parser.add_argument('--backend', choices=sorted(perft.BACKENDS), default='bitboard')
+    args = parser.parse_args()
+    if args.time is None and args.nodes is None and args.depth == 64:
+        args.time = 5.0
+
+    game_state_class = perft.BACKENDS[args.backend]
+    gs = game_state_class.from_fen(args.fen)
+    with ParallelSearch(args.workers, args.hash, game_state_class) as parallel:
+        result = parallel.search(gs, args.depth, args.nodes, args.time)
+    print(result)
+    print(f'{result.nodes} nodes in {result.seconds:.2f}s with {parallel.workers} workers, '
+          f'{round(result.nodes / result.seconds) if result.seconds else 0} nps')
+
+
+if __name__ == '__main__':
+    main()
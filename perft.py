@@ -0,0 +1,202 @@
+"""
+Perft (performance test) for the move generator. It walks the tree of legal moves to a fixed depth
+and counts the leaf nodes, which can be compared with the well known reference numbers.
+Run it with:
+    python perft.py                                  # reference suite on the default backend
+    python perft.py --fen "<fen>" --depth 3 --divide # nodes below every root move
+    python perft.py --backend bitboard --output perft_results.jsonl
+    python perft.py --profile                        # count the work done, see instrumentation.py
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import bitboard
+import chess_engine
+import instrumentation
+
+BACKENDS = {
+    'mailbox': chess_engine.GameState,
+    'bitboard': bitboard.BitboardGameState,
+}
+
+START_FEN = chess_engine.START_FEN
+
+# (name, fen, node counts for depth 1, 2, 3, ...)
+REFERENCE_POSITIONS = [
+    ('start position', START_FEN,
+        [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+        [48, 2039, 97862, 4085603]),
+    ('en passant and pins', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+        [14, 191, 2812, 43238, 674624]),
+    ('castling and promotions', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+        [6, 264, 9467, 422333]),
+    ('castling and promotions mirrored', 'r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1',
+        [6, 264, 9467, 422333]),
+    ('promotion with capture', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+        [44, 1486, 62379, 2103487]),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+        [46, 2079, 89890, 3894594]),
+    ('illegal en passant, horizontal pin', '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1',
+        [18, 92, 1670, 10138, 185429]),
+    ('illegal en passant, diagonal pin', '8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1',
+        [13, 102, 1266, 10276, 135655]),
+    ('en passant gives check', '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1',
+        [15, 126, 1928, 13931, 206379]),
+    ('short castling gives check', '5k2/8/8/8/8/8/8/4K2R w K - 0 1',
+        [15, 66, 1198, 6399, 120330]),
+    ('long castling gives check', '3k4/8/8/8/8/8/8/R3K3 w Q - 0 1',
+        [16, 71, 1286, 7418, 141077]),
+    ('castling rights', 'r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1',
+        [26, 1141, 27826, 1274206]),
+    ('castling prevented', 'r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1',
+        [44, 1494, 50509, 1720476]),
+    ('promote out of check', '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1',
+        [11, 133, 1442, 19174, 266199]),
+    ('discovered check', '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1',
+        [29, 165, 5160, 31961, 1004658]),
+    ('self stalemate', 'K1k5/8/P7/8/8/8/8/8 w - - 0 1',
+        [2, 6, 13, 63, 382, 2217]),
+    ('stalemate and checkmate', '8/k1P5/8/1K6/8/8/8/8 w - - 0 1',
+        [10, 25, 268, 926, 10857, 43261, 567584]),
+]
+
+
+def perft(gs, depth):
+    """
+    Count the leaf nodes of the legal move tree of the given depth.
+    """
+    if depth == 0:
+        return 1
+    moves = gs.get_valid_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1)
+        gs.undo_move()
+    return nodes
+
+
+def divide(gs, depth):
+    """
+    Perft split by root move, the first thing to look at when a count is wrong.
+    Returns a dict from the move notation to the number of nodes below it.
+    """
+    counts = {}
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        counts[move.get_chess_notation()] = perft(gs, depth - 1)
+        gs.undo_move()
+    return counts
+
+
+def timed_perft(game_state_class, fen, depth, profiler=None):
+    """
+    Run perft from a fresh position and return (nodes, seconds).
+    """
+    gs = game_state_class.from_fen(fen)
+    if profiler is not None:
+        profiler.attach(gs)
+    start = time.perf_counter()
+    nodes = perft(gs, depth)
+    return nodes, time.perf_counter() - start
+
+
+def run_suite(backend, max_depth, max_nodes, profiler=None):
+    """
+    Run every reference position up to max_depth, skipping depths with more than max_nodes expected nodes.
+    Returns a list of result dicts.
+    """
+    results = []
+    for name, fen, expected_counts in REFERENCE_POSITIONS:
+        for depth, expected in enumerate(expected_counts[:max_depth], start=1):
+            if expected > max_nodes:
+                break
+            nodes, seconds = timed_perft(BACKENDS[backend], fen, depth, profiler)
+            results.append(make_result(backend, name, fen, depth, nodes, seconds, expected))
+    return results
+
+
+def make_result(backend, name, fen, depth, nodes, seconds, expected=None):
+    return {
+        'backend': backend,
+        'name': name,
+        'fen': fen,
+        'depth': depth,
+        'nodes': nodes,
+        'expected': expected,
+        'ok': expected is None or nodes == expected,
+        'seconds': round(seconds, 6),
+        'nps': round(nodes / seconds) if seconds > 0 else 0,
+    }
+
+
+def print_result(result):
+    status = 'ok' if result['ok'] else f'FAIL (expected {result["expected"]})'
+    print(f'{result["name"]:<36} depth {result["depth"]}  {result["nodes"]:>9} nodes  '
+          f'{result["seconds"]:8.3f}s  {result["nps"]:>8} nps  {status}')
+
+
+def save_results(path, results, label):
+    """
+    Append one JSON line describing the run, so consecutive runs can be compared.
+    """
+    total_nodes = sum(r['nodes'] for r in results)
+    total_seconds = sum(r['seconds'] for r in results)
+    record = {
+        'label': label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'total_nodes': total_nodes,
+        'total_seconds': round(total_seconds, 6),
+        'nps': round(total_nodes / total_seconds) if total_seconds > 0 else 0,
+        'results': results,
+    }
+    with open(path, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count move generator leaf nodes and measure its speed.')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='mailbox')
+    parser.add_argument('--fen', help='run a single position instead of the reference suite')
+    parser.add_argument('--depth', type=int, default=3, help='depth for --fen')
+    parser.add_argument('--divide', action='store_true', help='print the node count below every root move')
+    parser.add_argument('--max-depth', type=int, default=3, help='deepest depth run by the suite')
+    parser.add_argument('--max-nodes', type=int, default=100000,
+                        help='skip suite depths expected to have more nodes than this')
+    parser.add_argument('--output', help='append the results as a JSON line to this file')
+    parser.add_argument('--label', default='', help='free text stored with the results, e.g. a commit hash')
+    parser.add_argument('--profile', choices=['json', 'prometheus'], nargs='?', const='json',
+                        help='count calls and time the phases of the move generator, slows it down')
+    args = parser.parse_args()
+    profiler = instrumentation.Profiler() if args.profile else None
+
+    if args.fen:
+        if args.divide:
+            gs = BACKENDS[args.backend].from_fen(args.fen)
+            counts = divide(gs, args.depth)
+            for notation in sorted(counts):
+                print(f'{notation}: {counts[notation]}')
+            print(f'\nMoves: {len(counts)}\nNodes: {sum(counts.values())}')
+            return 0
+        nodes, seconds = timed_perft(BACKENDS[args.backend], args.fen, args.depth, profiler)
+        results = [make_result(args.backend, 'custom', args.fen, args.depth, nodes, seconds)]
+    else:
+        results = run_suite(args.backend, args.max_depth, args.max_nodes, profiler)
+    for result in results:
+        print_result(result)
+    if profiler is not None:
+        print(profiler.to_json() if args.profile == 'json' else profiler.to_prometheus(), end='\n')
+    if args.output:
+        save_results(args.output, results, args.label)
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Batch analysis of PGN archives. Games are streamed from disk one at a time, replayed in a pool of worker
+processes and the results are written as JSON lines while the rest of the archive is still being read.
+Only a bounded number of games is in flight, so memory stays the same for a hundred games or a hundred million.
+Run it with:
+    python pgn_batch.py games.pgn --output results.jsonl
+    python pgn_batch.py games.pgn --workers 8 --depth 3   # also evaluate every position
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import chess_engine
+import perft
+import search
+
+TAG_RE = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+# Comments, variation brackets, NAGs and everything else separated by whitespace.
+TOKEN_RE = re.compile(r'\{[^}]*\}|;[^\n]*|[()]|\$\d+|[^\s(){};]+')
+MOVE_NUMBER_RE = re.compile(r'^\d+\.*')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+# Games waiting in the pool for every worker, enough to keep them busy without reading ahead too far.
+PENDING_PER_WORKER = 8
+
+_worker_search = None
+_worker_game_state_class = None
+
+
+def read_games(file):
+    """
+    Yield (tags, movetext) for every game of an open PGN file, reading it line by line.
+    """
+    tags = {}
+    movetext = []
+    for line in file:
+        line = line.strip()
+        if line.startswith('['):
+            if movetext:
+                yield tags, ' '.join(movetext)
+                tags, movetext = {}, []
+            match = TAG_RE.match(line)
+            if match:
+                tags[match.group(1)] = match.group(2)
+        elif line and not line.startswith('%'):
+            movetext.append(line)
+    if tags or movetext:
+        yield tags, ' '.join(movetext)
+
+
+def san_moves(movetext):
+    """
+    Yield the SAN moves of the main line, leaving out move numbers, comments, NAGs, variations and the result.
+    """
+    variation_depth = 0
+    for token in TOKEN_RE.findall(movetext):
+        if token == '(':
+            variation_depth += 1
+        elif token == ')':
+            variation_depth = max(0, variation_depth - 1)
+        elif variation_depth or token[0] in '{;$':
+            continue
+        elif token in RESULTS:
+            return
+        else:
+            token = MOVE_NUMBER_RE.sub('', token)
+            if token:
+                yield token
+
+
+def _init_worker(game_state_class, depth, nodes, tt_size_mb):
+    global _worker_search, _worker_game_state_class
+    _worker_game_state_class = game_state_class
+    if depth is not None or nodes is not None:
+        _worker_search = search.Search(tt_size_mb)
+
+
+def analyze_game(task):
+    """
+    Replay one game and return its result dict. Runs in a worker process.
+    """
+    index, tags, movetext, depth, nodes = task
+    result = {'game': index, 'white': tags.get('White'), 'black': tags.get('Black'), 'result': tags.get('Result'),
+              'moves': 0, 'legal': True, 'error': None}
+    try:
+        if tags.get('FEN'):
+            gs = _worker_game_state_class.from_fen(tags['FEN'])
+        else:
+            gs = _worker_game_state_class()
+    except ValueError as error:
+        result.update(legal=False, error=str(error), final_fen=None)
+        return result
+    evals = []
+    for san in san_moves(movetext):
+        try:
+            move = gs.parse_san(san)
+        except ValueError as error:
+            result.update(legal=False, error=str(error))
+            break
+        gs.make_move(move)
+        result['moves'] += 1
+        if _worker_search is not None:
+            score = _worker_search.search(gs, depth or search.MAX_PLY - 1, nodes).score
+            # Scores are written from white's point of view, so a column of them reads like a graph of the game.
+            evals.append(score if gs.white_to_move else -score)
+    result['final_fen'] = gs.to_fen()
+    if _worker_search is not None:
+        result['evals'] = evals
+    return result
+
+
+def analyze_archive(path, workers=None, depth=None, nodes=None, tt_size_mb=8,
+                    game_state_class=chess_engine.GameState):
+    """
+    Yield the result dicts of every game of a PGN file, in the order of the file.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * PENDING_PER_WORKER
+    with open(path, encoding='utf-8', errors='replace') as file, \
+            multiprocessing.Pool(workers, initializer=_init_worker,
+                                 initargs=(game_state_class, depth, nodes, tt_size_mb)) as pool:
+        # Pool.imap would read the whole archive ahead into its task queue, so the window is kept by hand.
+        pending = collections.deque()
+        for index, (tags, movetext) in enumerate(read_games(file)):
+            pending.append(pool.apply_async(analyze_game, ((index, tags, movetext, depth, nodes),)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay and analyze every game of a PGN file.')
+    parser.add_argument('pgn')
+    parser.add_argument('--output', help='JSON lines file for the results, stdout by default')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all cores by default')
+    parser.add_argument('--depth', type=int, default=None, help='evaluate every position to this depth')
+    parser.add_argument('--nodes', type=int, default=None, help='evaluate every position with this many nodes')
+    parser.add_argument('--hash', type=int, default=8, help='transposition table size per worker in MB')
+    parser.add_argument('--backend', choices=sorted(perft.BACKENDS), default='mailbox')
+    args = parser.parse_args()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    start = time.perf_counter()
+    games = illegal = 0
+    try:
+        for result in analyze_archive(args.pgn, args.workers, args.depth, args.nodes, args.hash,
+                                      perft.BACKENDS[args.backend]):
+            output.write(json.dumps(result) + '\n')
+            games += 1
+            illegal += not result['legal']
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    seconds = time.perf_counter() - start
+    print(f'{games} games ({illegal} with illegal moves) in {seconds:.2f}s, '
+          f'{games / seconds if seconds else 0:.1f} games/s', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
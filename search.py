@@ -0,0 +1,297 @@
+"""
+Alpha-beta search on top of GameState. Negamax with iterative deepening, a fixed size transposition
+table and a quiescence search over captures. Every search runs under optional node and time budgets.
+"""
+
+import time
+
+import evaluation
+import move_ordering
+
+MATE_SCORE = 100000
+# Scores beyond this are mates, their distance to the root is folded in when they go in or out of the table.
+MATE_BOUND = MATE_SCORE - 1000
+INFINITY = MATE_SCORE + 1
+MAX_PLY = 128
+# Budgets are checked once every this many nodes, looking at the clock on every node costs too much.
+CHECK_EVERY = 128
+
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+
+class SearchTimeout(Exception):
+    """
+    Raised inside the search when the node or time budget is used up.
+    """
+
+
+class TranspositionTable:
+    """
+    Fixed size hash table from Zobrist keys to search results. The number of slots is a power of two
+    and never grows, so memory stays bounded however long the search runs.
+    An entry is replaced when the new result is at least as deep, or when the old one is from an earlier search.
+    """
+    # Rough size of one slot in CPython: the key, a 5-tuple and the list slots pointing to them.
+    ENTRY_BYTES = 120
+
+    def __init__(self, size_mb=16):
+        entries = max(1, size_mb * 1024 * 1024 // self.ENTRY_BYTES)
+        self.size = 1 << (entries.bit_length() - 1)
+        self.mask = self.size - 1
+        self.keys = [0] * self.size
+        # Every entry is (depth, flag, score, move_id, age)
+        self.entries = [None] * self.size
+        self.age = 0
+
+    def new_search(self):
+        self.age = (self.age + 1) & 0xff
+
+    def clear(self):
+        self.keys = [0] * self.size
+        self.entries = [None] * self.size
+        self.age = 0
+
+    def probe(self, key):
+        index = key & self.mask
+        if self.keys[index] == key:
+            return self.entries[index]
+        return None
+
+    def store(self, key, depth, flag, score, move_id):
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry is None or self.keys[index] == key or depth >= entry[0] or entry[4] != self.age:
+            self.keys[index] = key
+            self.entries[index] = (depth, flag, score, move_id, self.age)
+
+
+class SearchResult:
+
+    def __init__(self, best_move, score, pv, nodes, depth, seconds):
+        self.best_move = best_move
+        self.score = score
+        self.pv = pv
+        self.nodes = nodes
+        self.depth = depth
+        self.seconds = seconds
+
+    def __repr__(self):
+        pv = ' '.join(move.get_chess_notation() for move in self.pv)
+        return f'SearchResult(depth: {self.depth}, score: {self.score}, nodes: {self.nodes}, pv: {pv})'
+
+
+class Search:
+    """
+    Keeps the transposition table between searches, so consecutive moves of a game can reuse it.
+    """
+
+    def __init__(self, tt_size_mb=16, ordering=None):
+        self.tt = TranspositionTable(tt_size_mb)
+        self.ordering = ordering if ordering is not None else move_ordering.MoveOrderer(max_ply=MAX_PLY)
+        self.nodes = 0
+        self.max_nodes = None
+        self.deadline = None
+        self.next_check = CHECK_EVERY
+        self.stopped = False
+        # Called at every budget check when set, the search stops when it returns True. This is how a
+        # caller adds its own limits, like a node budget shared with other processes.
+        self.should_stop = None
+
+    def stop(self):
+        """
+        Ask a running search to return as soon as possible. Safe to call from another thread,
+        the search notices it at its next budget check. A stop that comes just before the search
+        starts is not lost, it ends that search right away.
+        """
+        self.stopped = True
+
+    def search(self, gs, max_depth=64, max_nodes=None, max_time=None, on_iteration=None):
+        """
+        Search the position of gs with iterative deepening and return a SearchResult for the deepest
+        completed iteration. max_nodes and max_time (seconds) are hard limits, the search stops
+        as soon as one of them is used up. gs is left exactly as it was given.
+        on_iteration, when given, is called with the SearchResult of every completed iteration.
+        """
+        start = time.perf_counter()
+        self.new_search()
+        self.start_budget(max_nodes, max_time)
+        log_length = len(gs.move_log)
+
+        root_moves = gs.legal_moves()
+        if len(root_moves) == 0:
+            self.stopped = False
+            score = -MATE_SCORE if gs.in_check else 0
+            return SearchResult(None, score, [], 0, 0, time.perf_counter() - start)
+        result = SearchResult(root_moves[0], 0, [root_moves[0]], 0, 0, 0.0)
+        for depth in range(1, max_depth + 1):
+            try:
+                score, pv = self.negamax(gs, depth, -INFINITY, INFINITY, 0)
+            except SearchTimeout:
+                while len(gs.move_log) > log_length:
+                    gs.undo_move()
+                break
+            result = SearchResult(pv[0] if pv else root_moves[0], score, pv, self.nodes, depth,
+                                  time.perf_counter() - start)
+            if on_iteration is not None:
+                on_iteration(result)
+            if abs(score) >= MATE_BOUND:
+                break  # a mate was found, deeper iterations can not improve on it
+        self.stopped = False
+        result.nodes = self.nodes
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def start_budget(self, max_nodes, max_time):
+        self.nodes = 0
+        self.max_nodes = max_nodes
+        self.deadline = time.perf_counter() + max_time if max_time is not None else None
+        self.next_check = CHECK_EVERY
+
+    def new_search(self):
+        """
+        Age the transposition table and the move ordering tables, once for every search of a new position.
+        """
+        self.tt.new_search()
+        self.ordering.new_search()
+
+    def clear(self):
+        """
+        Forget everything learned in earlier searches, for a new game.
+        """
+        self.tt.clear()
+        self.ordering.clear()
+
+    def search_depth(self, gs, depth, ply=0, max_nodes=None, max_time=None, alpha=-INFINITY, beta=INFINITY):
+        """
+        A single search to a fixed depth and window, without iterative deepening. ply is the distance of gs
+        from the real root, so mate scores stay comparable when the caller splits up the tree. It is part of
+        the caller's search, call new_search() first when the root position changes.
+        Returns (score, principal variation), or None when the budget ran out first.
+        """
+        self.start_budget(max_nodes, max_time)
+        log_length = len(gs.move_log)
+        try:
+            return self.negamax(gs, depth, alpha, beta, ply)
+        except SearchTimeout:
+            while len(gs.move_log) > log_length:
+                gs.undo_move()
+            return None
+        finally:
+            self.stopped = False
+
+    def count_node(self):
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.next_check = self.nodes + CHECK_EVERY
+            if self.stopped or (self.deadline is not None and time.perf_counter() >= self.deadline) \
+                    or (self.should_stop is not None and self.should_stop()):
+                raise SearchTimeout()
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            raise SearchTimeout()
+
+    def negamax(self, gs, depth, alpha, beta, ply):
+        """
+        Returns (score, principal variation) of the position from the side to move's point of view.
+        """
+        # Repeating a position once is enough inside the tree, the side that is better will avoid it anyway.
+        if ply > 0 and (gs.position_counts[gs.zobrist_key] >= 2 or gs.halfmove_clock >= 100):
+            return 0, []
+        if depth <= 0:
+            return self.quiescence(gs, alpha, beta, ply), []
+        self.count_node()
+        original_alpha = alpha
+        key = gs.zobrist_key
+        tt_move_id = None
+        entry = self.tt.probe(key)
+        if entry is not None:
+            entry_depth, flag, score, tt_move_id, age = entry
+            if entry_depth >= depth and ply > 0:
+                score = score_from_tt(score, ply)
+                # An exact score has no line behind it, on a PV node it is searched instead so the PV stays whole.
+                if (flag == EXACT and beta - alpha == 1) or (flag == LOWER_BOUND and score >= beta) \
+                        or (flag == UPPER_BOUND and score <= alpha):
+                    return score, []
+
+        if ply >= MAX_PLY:
+            return evaluation.evaluate(gs), []
+
+        best_score = -INFINITY
+        best_move = None
+        best_pv = []
+        moves_searched = 0
+        for move, stage in self.ordering.ordered_moves(gs, tt_move_id, ply):
+            moves_searched += 1
+            gs.make_move(move)
+            score, child_pv = self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            score = -score
+            gs.undo_move()
+            if score > best_score:
+                best_score = score
+                best_move = move
+                best_pv = [move] + child_pv
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        self.ordering.record_cutoff(move, stage, moves_searched, depth, ply)
+                        break
+        if best_move is None:
+            return (-MATE_SCORE + ply if gs.sq_in_check() else 0), []
+
+        if best_score <= original_alpha:
+            flag = UPPER_BOUND
+        elif best_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, flag, score_to_tt(best_score, ply), best_move.move_id)
+        return best_score, best_pv
+
+    def quiescence(self, gs, alpha, beta, ply):
+        """
+        Only captures and promotions are searched, so the static evaluation is never taken in the middle of an exchange.
+        """
+        self.count_node()
+        # In check every evasion is searched, there is no standing pat when the king is attacked.
+        in_check = gs.sq_in_check()
+        if not in_check:
+            stand_pat = evaluation.evaluate(gs)
+            if stand_pat >= beta or ply >= MAX_PLY:
+                return stand_pat
+            if stand_pat > alpha:
+                alpha = stand_pat
+        moves_searched = 0
+        for move in gs.iter_moves(captures_only=not in_check):
+            moves_searched += 1
+            # Captures that lose material are not worth a look, unless they are the way out of check.
+            if not in_check and move.piece_captured != '--' and self.ordering.use_exchange \
+                    and move_ordering.is_losing_capture(gs.board, move):
+                continue
+            gs.make_move(move)
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        if in_check and moves_searched == 0:
+            return -MATE_SCORE + ply
+        return alpha
+
+
+def score_to_tt(score, ply):
+    # Mate scores are stored relative to the node, not to the root.
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
@@ -0,0 +1,259 @@
+"""
+Hosts many games in one process over a line based TCP protocol. A game is kept as a small packed record,
+not a GameState: the 67 bytes of GameState.to_bytes, the move counters, its moves as 16-bit move ids and
+the Zobrist keys since the last capture or pawn move, which are all repetitions can come from. A single
+GameState is loaded with the position of whichever game a request is for, so the work per move is setting
+up one board and checking the move.
+Run it with:
+    python server.py --port 8765
+Every request is one line and gets one line back, 'ok ...' or 'error <reason>':
+    new [fen]                       ok <game id>
+    move <game id> <move>           ok <move in UCI notation> <status>    the move in UCI or SAN
+    moves <game id>                 ok <legal moves in UCI notation>
+    fen <game id>                   ok <fen>
+    history <game id>               ok <start fen>; <moves in UCI notation>
+    status <game id>                ok <status>
+    close <game id>                 ok
+    stats                           ok games=<number> bytes_per_game=<bytes>
+    quit
+The status is 'ongoing', 'checkmate', 'stalemate' or the reason of a draw, like 'threefold repetition'.
+Games belong to the server, not to a connection, so a client that reconnects can carry on with its game ids.
+"""
+
+import argparse
+import array
+import asyncio
+import itertools
+import re
+import sys
+
+import chess_engine
+import perft
+
+DEFAULT_PORT = 8765
+# New games are refused beyond this, so memory stays bounded whatever the clients do.
+DEFAULT_MAX_GAMES = 100000
+# Longest request line accepted, a FEN with a command in front fits many times over.
+MAX_LINE_BYTES = 1024
+UCI_MOVE_RE = re.compile(r'^[a-h][1-8][a-h][1-8][qrbn]?$')
+
+
+class Game:
+    """
+    The packed state of one game. Moves and keys are arrays of plain numbers, not lists of objects.
+    """
+    __slots__ = ('start_fen', 'position', 'halfmove_clock', 'fullmove_number', 'moves', 'keys', 'status')
+
+    def __init__(self, start_fen, position, halfmove_clock, fullmove_number):
+        self.start_fen = start_fen
+        self.position = position
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        self.moves = array.array('H')
+        # Keys of the earlier positions that can still come back, repetitions are counted from them.
+        self.keys = array.array('Q')
+        self.status = 'ongoing'
+
+    def memory(self):
+        """
+        Bytes taken by the record and what it owns. The start FEN is left out, games mostly share the same one.
+        """
+        return (sys.getsizeof(self) + sys.getsizeof(self.position) + sys.getsizeof(self.halfmove_clock)
+                + sys.getsizeof(self.fullmove_number) + sys.getsizeof(self.moves) + sys.getsizeof(self.keys))
+
+
+class GameServer:
+    """
+    All the games of the process and the one GameState they are played on. Every method named
+    command_<name> handles one request and returns the reply. They never wait, so requests are
+    handled one after another and a game never sees two moves at once.
+    """
+
+    def __init__(self, game_state_class=chess_engine.GameState, max_games=DEFAULT_MAX_GAMES):
+        self.gs = game_state_class()
+        self.games = {}
+        self.game_ids = itertools.count(1)
+        self.max_games = max_games
+
+    def load(self, game):
+        """
+        Put the position of game on self.gs, with the positions it could repeat.
+        """
+        gs = self.gs
+        gs.set_bytes(game.position, game.halfmove_clock, game.fullmove_number)
+        counts = gs.position_counts
+        for key in game.keys:
+            counts[key] = counts.get(key, 0) + 1
+        return gs
+
+    def game(self, tokens):
+        if not tokens:
+            raise ValueError('missing game id')
+        game = self.games.get(tokens[0])
+        if game is None:
+            raise ValueError(f'no game {tokens[0]}')
+        return game
+
+    def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return 'error empty request'
+        handler = getattr(self, 'command_' + tokens[0], None)
+        if handler is None:
+            return f'error unknown command {tokens[0]}'
+        try:
+            return handler(tokens[1:])
+        except ValueError as error:
+            return f'error {error}'
+        except Exception as error:
+            # A bug must not take the connection, or the other games, down with it.
+            print(f'Request {line!r} failed: {error!r}', file=sys.stderr)
+            return f'error internal error {type(error).__name__}'
+
+    def command_new(self, tokens):
+        if len(self.games) >= self.max_games:
+            raise ValueError('too many games')
+        fen = ' '.join(tokens) if tokens else chess_engine.START_FEN
+        gs = self.gs
+        gs.set_fen(fen)
+        self.check_position(gs)
+        # The start position is written back from the board, so every game of the usual start shares one string.
+        start_fen = gs.to_fen()
+        if start_fen == chess_engine.START_FEN:
+            start_fen = chess_engine.START_FEN
+        game = Game(start_fen, gs.to_bytes(), gs.halfmove_clock, gs.first_fullmove_number)
+        game.status = self.status(gs)
+        game_id = str(next(self.game_ids))
+        self.games[game_id] = game
+        return f'ok {game_id}'
+
+    def command_move(self, tokens):
+        game = self.game(tokens)
+        if len(tokens) < 2:
+            raise ValueError('missing move')
+        if game.status != 'ongoing':
+            raise ValueError(f'game is over: {game.status}')
+        gs = self.load(game)
+        move = self.find_move(gs, tokens[1])
+        key = gs.zobrist_key
+        gs.make_move(move)
+        game.moves.append(move.move_id)
+        if gs.halfmove_clock == 0:
+            # After a capture or a pawn move none of the earlier positions can come back.
+            game.keys = array.array('Q')
+        else:
+            game.keys.append(key)
+        game.position = gs.to_bytes()
+        game.halfmove_clock = gs.halfmove_clock
+        if gs.white_to_move:
+            game.fullmove_number += 1
+        game.status = self.status(gs)
+        return f'ok {move.get_chess_notation()} {game.status}'
+
+    def command_moves(self, tokens):
+        gs = self.load(self.game(tokens))
+        return ' '.join(['ok'] + [move.get_chess_notation() for move in gs.legal_moves()])
+
+    def command_fen(self, tokens):
+        return 'ok ' + self.load(self.game(tokens)).to_fen()
+
+    def command_history(self, tokens):
+        game = self.game(tokens)
+        gs = self.gs
+        gs.set_fen(game.start_fen)
+        moves = []
+        for move_id in game.moves:
+            move = chess_engine.Move.from_id(move_id, gs.board)
+            moves.append(move.get_chess_notation())
+            gs.make_move(move)
+        return f'ok {game.start_fen}; {" ".join(moves)}'
+
+    def command_status(self, tokens):
+        return 'ok ' + self.game(tokens).status
+
+    def command_close(self, tokens):
+        self.game(tokens)
+        del self.games[tokens[0]]
+        return 'ok'
+
+    def command_stats(self, tokens):
+        bytes_per_game = sum(game.memory() for game in self.games.values()) // len(self.games) if self.games else 0
+        return f'ok games={len(self.games)} bytes_per_game={bytes_per_game}'
+
+    @staticmethod
+    def find_move(gs, text):
+        """
+        The legal move written in UCI notation, like 'e2e4' or 'e7e8q', or else in SAN.
+        """
+        if UCI_MOVE_RE.match(text):
+            for move in gs.legal_moves():
+                if move.get_chess_notation() == text:
+                    return move
+            raise ValueError(f'illegal move {text}')
+        return gs.parse_san(text)
+
+    @staticmethod
+    def check_position(gs):
+        """
+        set_fen refuses what a FEN can not describe, this refuses the positions no game can reach:
+        the side that just moved can not have left its king attacked.
+        """
+        if gs.white_to_move:
+            row, col = gs.black_king_location
+        else:
+            row, col = gs.white_king_location
+        if gs.is_square_attacked(row, col, 'w' if gs.white_to_move else 'b'):
+            raise ValueError('the side not to move is in check')
+
+    @staticmethod
+    def status(gs):
+        # Only whether there is any legal move is needed, the generator stops at the first one.
+        if not gs.has_legal_move():
+            return 'checkmate' if gs.sq_in_check() else 'stalemate'
+        return gs.draw_reason() or 'ongoing'
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(b'error line too long\n')
+                    break
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if line == 'quit':
+                    break
+                writer.write(self.handle(line).encode() + b'\n')
+                # A client that does not read its replies is not allowed to fill up the memory with them.
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.serve_client, host, port, limit=MAX_LINE_BYTES)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Host many games over a line based TCP protocol.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max-games', type=int, default=DEFAULT_MAX_GAMES)
+    parser.add_argument('--backend', choices=sorted(perft.BACKENDS), default='mailbox')
+    args = parser.parse_args()
+    game_server = GameServer(perft.BACKENDS[args.backend], args.max_games)
+    print(f'Listening on {args.host}:{args.port}', file=sys.stderr)
+    try:
+        asyncio.run(game_server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
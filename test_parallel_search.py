@@ -0,0 +1,37 @@
+"""
+Checks of the parallel search against the serial one. Run them with:
+    python -m unittest test_parallel_search
+"""
+
+import unittest
+
+import chess_engine
+import parallel_search
+import perft
+import search
+
+KIWIPETE = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q2/PPPBBPPP/R3K2R w KQkq - 0 1'
+
+
+class NodeBudgetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.parallel = parallel_search.ParallelSearch(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.parallel.close()
+
+    def test_reaches_serial_depth(self):
+        for fen in (KIWIPETE, perft.START_FEN):
+            for max_nodes in (5000, 20000, 100000):
+                with self.subTest(fen=fen, max_nodes=max_nodes):
+                    serial = search.Search().search(chess_engine.GameState.from_fen(fen), max_nodes=max_nodes)
+                    parallel = self.parallel.search(chess_engine.GameState.from_fen(fen), max_nodes=max_nodes)
+                    self.assertGreaterEqual(parallel.depth, serial.depth)
+                    self.assertIsNotNone(parallel.best_move)
+
+
+if __name__ == '__main__':
+    unittest.main()
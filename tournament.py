@@ -0,0 +1,366 @@
+"""
+Self-play tournaments between two engine configurations, to tell whether a change makes the engine
+stronger. Every opening of the suite is played twice with the colours swapped, the games run in a pool
+of worker processes and are written to a PGN file as they finish. With --sprt the match stops as soon as
+a sequential probability ratio test accepts one of its two hypotheses, usually long before --games.
+Run it with:
+    python tournament.py --engine name=new,depth=4 --engine name=base,depth=3 --games 200 --pgn match.pgn
+    python tournament.py --engine name=new,nodes=20000 --engine name=base,nodes=10000 --sprt elo0=0,elo1=20
+An engine is given as comma separated key=value pairs: name, depth, nodes, seconds (per move) and hash (MB).
+The openings file has one FEN or EPD per line, an EPD `id "..."` names the opening.
+"""
+
+import argparse
+import datetime
+import math
+import multiprocessing
+import os
+import re
+import sys
+import textwrap
+import time
+
+import chess_engine
+import perft
+import search
+
+# A few well known openings, used when no suite is given. Both engines get to play both sides of each.
+DEFAULT_OPENINGS = (
+    ('Italian Game', 'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'),
+    ('Ruy Lopez', 'r1bqkbnr/1ppp1ppp/p1n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 0 4'),
+    ('Sicilian Najdorf', 'rnbqkb1r/1p2pppp/p2p1n2/8/3NP3/2N5/PPP2PPP/R1BQKB1R w KQkq - 0 6'),
+    ('French Defence', 'rnbqkb1r/ppp2ppp/4pn2/3p4/3PP3/2N5/PPP2PPP/R1BQKBNR w KQkq - 2 4'),
+    ('Caro-Kann Defence', 'rn1qkbnr/pp2pppp/2p5/5b2/3PN3/8/PPP2PPP/R1BQKBNR w KQkq - 1 5'),
+    ("Queen's Gambit Declined", 'rnbqkb1r/ppp2ppp/4pn2/3p4/2PP4/2N5/PP2PPPP/R1BQKBNR w KQkq - 2 4'),
+    ("King's Indian Defence", 'rnbqk2r/ppp1ppbp/3p1np1/8/2PPP3/2N5/PP3PPP/R1BQKBNR w KQkq - 0 5'),
+    ('English Opening', 'rnbqkb1r/ppp2ppp/5n2/3pp3/2P5/2N3P1/PP1PPP1P/R1BQKBNR w KQkq - 0 4'),
+    ('Slav Defence', 'rnbqkb1r/pp2pppp/2p2n2/3p4/2PP4/5N2/PP2PPPP/RNBQKB1R w KQkq - 2 4'),
+    ('Scandinavian Defence', 'rnb1kbnr/ppp1pppp/8/q7/8/2N5/PPPP1PPP/R1BQKBNR w KQkq - 2 4'),
+)
+EPD_ID_RE = re.compile(r'\bid\s+"([^"]*)"')
+# Engines without any limit search to this depth.
+DEFAULT_DEPTH = 3
+# Plies after which a game nothing else ended is adjudicated a draw.
+DEFAULT_MAX_PLIES = 300
+# How often the standings are printed, in games.
+REPORT_EVERY = 20
+
+_worker_game_state_class = None
+_worker_searches = None
+
+
+class EngineConfig:
+    """
+    The settings one side of the match plays with.
+    """
+    KEYS = {'name': str, 'depth': int, 'nodes': int, 'seconds': float, 'hash': int}
+
+    def __init__(self, name, depth=None, nodes=None, seconds=None, hash_mb=8):
+        self.name = name
+        if depth is None and nodes is None and seconds is None:
+            depth = DEFAULT_DEPTH
+        self.depth = depth
+        self.nodes = nodes
+        self.seconds = seconds
+        self.hash_mb = hash_mb
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Read an engine from 'name=new,depth=4,hash=16'. Raises ValueError for unknown keys or bad values.
+        """
+        settings = {}
+        for item in text.split(','):
+            key, _, value = item.partition('=')
+            key = key.strip()
+            if key not in cls.KEYS or not value:
+                raise ValueError(f'Invalid engine setting {item!r}, expected one of {", ".join(cls.KEYS)}')
+            settings[key] = cls.KEYS[key](value.strip())
+        if 'name' not in settings:
+            raise ValueError(f'Engine {text!r} has no name')
+        if 'hash' in settings:
+            settings['hash_mb'] = settings.pop('hash')
+        return cls(**settings)
+
+    def __repr__(self):
+        limits = ', '.join(f'{key}={getattr(self, key)}' for key in ('depth', 'nodes', 'seconds')
+                           if getattr(self, key) is not None)
+        return f'{self.name} ({limits}, hash={self.hash_mb}MB)'
+
+
+class SPRT:
+    """
+    Sequential probability ratio test between H0: the first engine is elo0 stronger, and H1: it is elo1
+    stronger. The log-likelihood ratio uses the normal approximation for win/draw/loss results, so it is
+    cheap enough to update after every game. alpha and beta are the chances of accepting the wrong one.
+    """
+
+    def __init__(self, elo0=0.0, elo1=10.0, alpha=0.05, beta=0.05):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.alpha = alpha
+        self.beta = beta
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Read the test from 'elo0=0,elo1=10,alpha=0.05,beta=0.05', all of them optional.
+        """
+        settings = {}
+        for item in filter(None, text.split(',')):
+            key, _, value = item.partition('=')
+            if key.strip() not in ('elo0', 'elo1', 'alpha', 'beta'):
+                raise ValueError(f'Invalid SPRT setting {item!r}')
+            settings[key.strip()] = float(value)
+        return cls(**settings)
+
+    def llr(self, wins, draws, losses):
+        games = wins + draws + losses
+        if games == 0:
+            return 0.0
+        score = (wins + draws / 2) / games
+        variance = (wins + draws / 4) / games - score ** 2
+        if variance <= 0:
+            return 0.0  # all games had the same result, there is nothing to measure yet
+        score0, score1 = expected_score(self.elo0), expected_score(self.elo1)
+        return games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+    def decision(self, wins, draws, losses):
+        """
+        'H1' once the first engine is shown to be elo1 stronger, 'H0' once it is shown not to be, else None.
+        """
+        llr = self.llr(wins, draws, losses)
+        if llr >= self.upper:
+            return 'H1'
+        if llr <= self.lower:
+            return 'H0'
+        return None
+
+
+def expected_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def elo_difference(score):
+    return -400 * math.log10(1 / score - 1)
+
+
+def elo_estimate(wins, draws, losses):
+    """
+    The Elo difference the results point to and the half width of its 95% confidence interval.
+    """
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    if score <= 0 or score >= 1:
+        return (math.inf if score >= 1 else -math.inf), math.inf
+    deviation = math.sqrt(max((wins + draws / 4) / games - score ** 2, 0) / games)
+    low, high = max(score - 1.96 * deviation, 1e-9), min(score + 1.96 * deviation, 1 - 1e-9)
+    return elo_difference(score), (elo_difference(high) - elo_difference(low)) / 2
+
+
+def read_openings(path):
+    """
+    The (name, FEN) openings of a file with one FEN or EPD per line. Raises ValueError for a bad position.
+    """
+    openings = []
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            fen = ' '.join(fields[:4])
+            # A FEN ends with the two move counters, an EPD has operations there instead.
+            if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+                fen += f' {fields[4]} {fields[5]}'
+            else:
+                fen += ' 0 1'
+            try:
+                chess_engine.GameState.from_fen(fen)
+            except ValueError as error:
+                raise ValueError(f'{path}:{line_number}: {error}') from None
+            match = EPD_ID_RE.search(line)
+            openings.append((match.group(1) if match else f'{os.path.basename(path)}:{line_number}', fen))
+    if not openings:
+        raise ValueError(f'{path} has no openings')
+    return openings
+
+
+def _init_worker(game_state_class, engines):
+    global _worker_game_state_class, _worker_searches
+    _worker_game_state_class = game_state_class
+    _worker_searches = {engine.name: search.Search(engine.hash_mb) for engine in engines}
+
+
+def play_game(task):
+    """
+    Play one game and return its result dict. Runs in a worker process.
+    """
+    index, opening, fen, white, black, max_plies = task
+    gs = _worker_game_state_class.from_fen(fen)
+    for engine in (white, black):
+        # Every game starts with nothing learned, so it does not depend on which games the worker played before.
+        _worker_searches[engine.name].clear()
+    moves = []
+    while True:
+        gs.get_valid_moves()
+        if gs.check_mate:
+            result, termination = ('0-1' if gs.white_to_move else '1-0'), 'checkmate'
+            break
+        if gs.stale_mate:
+            result, termination = '1/2-1/2', 'stalemate'
+            break
+        if gs.draw:
+            result, termination = '1/2-1/2', gs.draw
+            break
+        if len(moves) >= max_plies:
+            result, termination = '1/2-1/2', 'move cap'
+            break
+        engine = white if gs.white_to_move else black
+        best_move = _worker_searches[engine.name].search(
+            gs, engine.depth or search.MAX_PLY - 1, engine.nodes, engine.seconds).best_move
+        moves.append(gs.move_to_san(best_move))
+        gs.make_move(best_move)
+    return {'game': index, 'opening': opening, 'fen': fen, 'white': white.name, 'black': black.name,
+            'result': result, 'termination': termination, 'moves': moves}
+
+
+def format_pgn(game, event, date):
+    """
+    The game as a PGN record, the move cap counts as an adjudication.
+    """
+    tags = [('Event', event), ('Site', '?'), ('Date', date), ('Round', str(game['game'] + 1)),
+            ('White', game['white']), ('Black', game['black']), ('Result', game['result'])]
+    if game['fen'] != chess_engine.START_FEN:
+        tags += [('SetUp', '1'), ('FEN', game['fen'])]
+    tags += [('Opening', game['opening']), ('PlyCount', str(len(game['moves']))),
+             ('Termination', 'adjudication' if game['termination'] == 'move cap' else 'normal')]
+    fields = game['fen'].split()
+    white_to_move, move_number = fields[1] == 'w', int(fields[5])
+    tokens = []
+    for san in game['moves']:
+        if white_to_move:
+            tokens.append(f'{move_number}.')
+        elif not tokens:
+            tokens.append(f'{move_number}...')
+        tokens.append(san)
+        if not white_to_move:
+            move_number += 1
+        white_to_move = not white_to_move
+    tokens += ['{' + game['termination'] + '}', game['result']]
+    lines = [f'[{name} "{value}"]' for name, value in tags]
+    movetext = textwrap.fill(' '.join(tokens), 79, break_long_words=False, break_on_hyphens=False)
+    return '\n'.join(lines) + '\n\n' + movetext + '\n\n'
+
+
+def schedule(engines, openings, games, max_plies):
+    """
+    Yield the games to play: every opening once with each engine as white, going round the suite.
+    """
+    first, second = engines
+    for index in range(games):
+        opening, fen = openings[index // 2 % len(openings)]
+        white, black = (first, second) if index % 2 == 0 else (second, first)
+        yield index, opening, fen, white, black, max_plies
+
+
+def run_match(engines, openings, games, workers=None, max_plies=DEFAULT_MAX_PLIES, sprt=None,
+              game_state_class=chess_engine.GameState):
+    """
+    Yield (game, (wins, draws, losses), decision) for every finished game, counted for the first engine.
+    The match ends after the last game, or right after the game on which the SPRT reached its decision.
+    """
+    workers = workers or os.cpu_count() or 1
+    wins = draws = losses = 0
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(game_state_class, engines)) as pool:
+        for game in pool.imap_unordered(play_game, schedule(engines, openings, games, max_plies)):
+            if game['result'] == '1/2-1/2':
+                draws += 1
+            elif (game['result'] == '1-0') == (game['white'] == engines[0].name):
+                wins += 1
+            else:
+                losses += 1
+            decision = sprt.decision(wins, draws, losses) if sprt is not None else None
+            yield game, (wins, draws, losses), decision
+            if decision is not None:
+                return  # leaving the with block terminates the games still running
+
+
+def _argument(parse):
+    """
+    Let argparse show the message of the ValueError a parse function raises.
+    """
+    def convert(text):
+        try:
+            return parse(text)
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(str(error)) from None
+    return convert
+
+
+def standings(engines, wins, draws, losses, sprt):
+    games = wins + draws + losses
+    elo, margin = elo_estimate(wins, draws, losses)
+    line = (f'{engines[0].name} vs {engines[1].name}: {wins} - {losses} - {draws} '
+            f'[{(wins + draws / 2) / games:.3f}] {games} games, Elo {elo:+.1f} +/- {margin:.1f}')
+    if sprt is not None:
+        line += f', LLR {sprt.llr(wins, draws, losses):.2f} ({sprt.lower:.2f}, {sprt.upper:.2f})'
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play a match between two engine configurations.')
+    parser.add_argument('--engine', type=_argument(EngineConfig.parse), action='append', required=True,
+                        help='name=...,depth=...,nodes=...,seconds=...,hash=..., given twice')
+    parser.add_argument('--games', type=int, default=100, help='most games to play, rounded up to pairs')
+    parser.add_argument('--openings', help='file with one FEN or EPD per line, a built-in suite by default')
+    parser.add_argument('--pgn', help='write the games to this PGN file')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all cores by default')
+    parser.add_argument('--max-plies', type=int, default=DEFAULT_MAX_PLIES, help='adjudicate a draw after this many plies')
+    parser.add_argument('--sprt', type=_argument(SPRT.parse), default=None, help='elo0=...,elo1=...,alpha=...,beta=...')
+    parser.add_argument('--backend', choices=sorted(perft.BACKENDS), default='mailbox')
+    args = parser.parse_args()
+
+    if len(args.engine) != 2 or args.engine[0].name == args.engine[1].name:
+        parser.error('give exactly two engines with different names')
+    try:
+        openings = read_openings(args.openings) if args.openings else list(DEFAULT_OPENINGS)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    games = args.games + args.games % 2
+    print(f'{args.engine[0]} vs {args.engine[1]}, {games} games from {len(openings)} openings', file=sys.stderr)
+
+    output = open(args.pgn, 'w') if args.pgn else None
+    event = f'{args.engine[0].name} vs {args.engine[1].name}'
+    date = datetime.date.today().strftime('%Y.%m.%d')
+    start = time.perf_counter()
+    wins = draws = losses = 0
+    decision = None
+    try:
+        for game, (wins, draws, losses), decision in run_match(args.engine, openings, games, args.workers,
+                                                               args.max_plies, args.sprt,
+                                                               perft.BACKENDS[args.backend]):
+            if output is not None:
+                output.write(format_pgn(game, event, date))
+            if (wins + draws + losses) % REPORT_EVERY == 0:
+                print(standings(args.engine, wins, draws, losses, args.sprt), file=sys.stderr)
+    finally:
+        if output is not None:
+            output.close()
+    seconds = time.perf_counter() - start
+    played = wins + draws + losses
+    if played:
+        print(standings(args.engine, wins, draws, losses, args.sprt))
+    if decision is not None:
+        accepted = args.sprt.elo1 if decision == 'H1' else args.sprt.elo0
+        print(f'SPRT accepted {decision} (Elo difference {accepted:+g}) after {played} games')
+    elif args.sprt is not None:
+        print(f'SPRT undecided after {played} games')
+    print(f'{played} games in {seconds:.1f}s, {played / seconds if seconds else 0:.2f} games/s', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+UCI (Universal Chess Interface) front end, so the engine can be run by chess GUIs and match managers.
+Commands are read from stdin by asyncio while the search runs in a thread, so stop, isready and ponderhit
+are answered right away even in the middle of a search.
+Run it with:
+    python uci.py
+"""
+
+import asyncio
+import sys
+import threading
+import time
+
+import opening_book
+import perft
+import search
+
+ENGINE_NAME = 'ChessGameTutorial'
+ENGINE_AUTHOR = 'ChessGameTutorial contributors'
+# Time kept back on every move for the GUI and the pipes, in seconds.
+MOVE_OVERHEAD = 0.05
+# With no movestogo the remaining time is shared as if this many moves were left.
+DEFAULT_MOVES_TO_GO = 30
+
+
+def score_to_uci(score):
+    """
+    'cp <centipawns>' or 'mate <moves>', negative when the side to move is getting mated.
+    """
+    if score >= search.MATE_BOUND:
+        return f'mate {(search.MATE_SCORE - score + 1) // 2}'
+    if score <= -search.MATE_BOUND:
+        return f'mate {-((search.MATE_SCORE + score) // 2)}'
+    return f'cp {score}'
+
+
+def info_line(result):
+    milliseconds = max(1, round(result.seconds * 1000))
+    pv = ' '.join(move.get_chess_notation() for move in result.pv)
+    return (f'info depth {result.depth} score {score_to_uci(result.score)} nodes {result.nodes} '
+            f'nps {result.nodes * 1000 // milliseconds} time {milliseconds} pv {pv}')
+
+
+def parse_go(tokens, on_invalid=None):
+    """
+    Turn the arguments of a go command into a dict, numbers are converted to int.
+    A value that is not a number is left out, on_invalid is called with its name and value when given.
+    """
+    limits = {}
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token in ('infinite', 'ponder'):
+            limits[token] = True
+        elif token in ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'movetime', 'depth', 'nodes', 'mate') \
+                and index + 1 < len(tokens):
+            index += 1
+            try:
+                limits[token] = int(tokens[index])
+            except ValueError:
+                if on_invalid is not None:
+                    on_invalid(token, tokens[index])
+        index += 1
+    return limits
+
+
+def time_for_move(limits, white_to_move):
+    """
+    Seconds to spend on this move, or None when the search is not limited by time.
+    """
+    if 'movetime' in limits:
+        return max(0.001, limits['movetime'] / 1000 - MOVE_OVERHEAD)
+    remaining = limits.get('wtime' if white_to_move else 'btime')
+    if remaining is None:
+        return None
+    remaining /= 1000
+    increment = limits.get('winc' if white_to_move else 'binc', 0) / 1000
+    moves_to_go = limits.get('movestogo', DEFAULT_MOVES_TO_GO)
+    budget = remaining / max(1, moves_to_go) + increment * 0.8
+    return max(0.001, min(budget, remaining - MOVE_OVERHEAD))
+
+
+class UciEngine:
+    """
+    Keeps the position and the search between commands. Every method named uci_<command> handles one command.
+    """
+
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.backend = 'mailbox'
+        self.hash_mb = 16
+        self.searcher = search.Search(self.hash_mb)
+        self.book = None
+        self.gs = perft.BACKENDS[self.backend]()
+        self.loop = None
+        self.search_task = None
+        # Set when a search may print its bestmove, cleared while the GUI is still pondering or analysing.
+        self.may_finish = threading.Event()
+        self.pending_time = None
+        self.quitting = False
+
+    def send(self, line):
+        self.output.write(line + '\n')
+        self.output.flush()
+
+    def send_threadsafe(self, line):
+        # The search thread never writes itself, the lines go out in order from the event loop.
+        self.loop.call_soon_threadsafe(self.send, line)
+
+    async def run(self, input_stream=sys.stdin):
+        self.loop = asyncio.get_running_loop()
+        while not self.quitting:
+            line = await self.loop.run_in_executor(None, input_stream.readline)
+            if not line:
+                break  # the GUI closed the pipe
+            await self.handle(line)
+        await self.stop_search()
+        if self.book is not None:
+            self.book.close()
+
+    async def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return
+        handler = getattr(self, 'uci_' + tokens[0], None)
+        if handler is not None:
+            await handler(tokens[1:])
+
+    async def uci_uci(self, tokens):
+        self.send(f'id name {ENGINE_NAME}')
+        self.send(f'id author {ENGINE_AUTHOR}')
+        self.send(f'option name Hash type spin default {self.hash_mb} min 1 max 1024')
+        self.send(f'option name Backend type combo default {self.backend} '
+                  + ' '.join(f'var {name}' for name in sorted(perft.BACKENDS)))
+        self.send('option name Ponder type check default false')
+        self.send('option name BookFile type string default <empty>')
+        self.send('uciok')
+
+    async def uci_isready(self, tokens):
+        self.send('readyok')
+
+    async def uci_setoption(self, tokens):
+        if 'name' not in tokens:
+            return
+        value_index = tokens.index('value') if 'value' in tokens else len(tokens)
+        name = ' '.join(tokens[tokens.index('name') + 1:value_index]).lower()
+        value = ' '.join(tokens[value_index + 1:])
+        await self.stop_search()
+        if name == 'hash' and value.isdigit():
+            self.hash_mb = int(value)
+            self.searcher = search.Search(self.hash_mb)
+        elif name == 'bookfile':
+            if self.book is not None:
+                self.book.close()
+                self.book = None
+            if value and value != '<empty>':
+                try:
+                    self.book = opening_book.OpeningBook(value)
+                except OSError as error:
+                    self.send(f'info string can not open book: {error}')
+        elif name == 'backend' and value in perft.BACKENDS:
+            self.backend = value
+            self.gs = perft.BACKENDS[self.backend]()
+
+    async def uci_ucinewgame(self, tokens):
+        await self.stop_search()
+        self.searcher.clear()
+
+    async def uci_position(self, tokens):
+        await self.stop_search()
+        moves_index = tokens.index('moves') if 'moves' in tokens else len(tokens)
+        if tokens and tokens[0] == 'fen':
+            fen = ' '.join(tokens[1:moves_index])
+        else:
+            fen = perft.START_FEN
+        try:
+            self.gs = perft.BACKENDS[self.backend].from_fen(fen)
+        except ValueError as error:
+            self.send(f'info string {error}')
+            return
+        for notation in tokens[moves_index + 1:]:
+            for move in self.gs.legal_moves():
+                if move.get_chess_notation() == notation:
+                    self.gs.make_move(move)
+                    break
+            else:
+                self.send(f'info string illegal move {notation}')
+                break
+
+    async def uci_go(self, tokens):
+        await self.stop_search()
+        limits = parse_go(tokens, lambda name, value: self.send(f'info string invalid {name} value {value}'))
+        if self.book is not None and not limits.get('infinite') and not limits.get('ponder'):
+            book_move = self.book.choose(self.gs)
+            if book_move is not None:
+                self.send('info string book move')
+                self.send(f'bestmove {book_move.get_chess_notation()}')
+                return
+        max_time = time_for_move(limits, self.gs.white_to_move)
+        max_depth = limits.get('depth', search.MAX_PLY - 1)
+        if 'mate' in limits:
+            max_depth = min(max_depth, limits['mate'] * 2)
+        if limits.get('infinite') or limits.get('ponder'):
+            # No bestmove before stop or ponderhit, the clock only starts when the ponder move is played.
+            self.pending_time = max_time if limits.get('ponder') else None
+            max_time = None
+            self.may_finish.clear()
+        else:
+            self.pending_time = None
+            self.may_finish.set()
+        self.search_task = self.loop.create_task(
+            self.run_search(max_depth, limits.get('nodes'), max_time))
+
+    async def run_search(self, max_depth, max_nodes, max_time):
+        def on_iteration(result):
+            self.send_threadsafe(info_line(result))
+
+        def search_and_wait():
+            result = self.searcher.search(self.gs, max_depth, max_nodes, max_time, on_iteration)
+            self.may_finish.wait()
+            return result
+
+        result = await self.loop.run_in_executor(None, search_and_wait)
+        if result.best_move is None:
+            self.send('bestmove 0000')
+            return
+        best_move = result.best_move.get_chess_notation()
+        if len(result.pv) > 1:
+            self.send(f'bestmove {best_move} ponder {result.pv[1].get_chess_notation()}')
+        else:
+            self.send(f'bestmove {best_move}')
+
+    async def uci_ponderhit(self, tokens):
+        if self.pending_time is not None:
+            # The search keeps going, it just gets a deadline now that it is our move for real.
+            self.searcher.deadline = time.perf_counter() + self.pending_time
+            self.pending_time = None
+        self.may_finish.set()
+
+    async def uci_stop(self, tokens):
+        await self.stop_search()
+
+    async def uci_quit(self, tokens):
+        self.quitting = True
+
+    async def stop_search(self):
+        """
+        Stop the running search, if any, and wait until its bestmove has been sent.
+        """
+        if self.search_task is None:
+            return
+        self.searcher.stop()
+        self.may_finish.set()
+        await self.search_task
+        self.search_task = None
+        # The search may have finished on its own before the stop came, it must not stop the next one.
+        self.searcher.stopped = False
+
+
+def main():
+    asyncio.run(UciEngine().run())
+
+
+if __name__ == '__main__':
+    main()